@@ -3,9 +3,16 @@ import streamlit as st; st.set_page_config(layout="wide")
 import ETL as etl
 import data_aggregation_tools as da
 import charting_tools
+import refresh_worker
+import profiling
+import currency
+import analytics
 
 import pandas as pd
 import datetime as dt
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import plotly.express as px
 from plotly.offline import iplot
@@ -22,49 +29,112 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# hidden debug panel, open the app with ?debug=1
+debug = st.query_params.get('debug') == '1'
+if debug:
+    profiling.start()
+
+@profiling.profiled
 def data_prep():
-    """ prep data before running the app"""
-    df = etl.read_data()
-    #start_date = df['Date'].min()
-    end_date = df['Date'].max()
-    #end_date = dt.date.today()
-    start_date = dt.date(2023, 2, 15)
+    """ the ETL runs in the background refresh worker, the app waits only until there are outputs to show"""
     #end_date = dt.date(2023, 10, 24)
     #end_date = dt.date.today()
     #end_date = dt.date.today() - dt.timedelta(days=1)
-    etl.extract_relevant_txs(df, start_date, end_date)
-
-# ! Run once to ETL the data then comment out and run the app
-
-data_prep()
+    refresh_worker.start()
+    if not refresh_worker.wait_ready(timeout=600):
+        if refresh_worker.status['error']:
+            st.error(f"No data, the refresh of the export failed: {refresh_worker.status['error']}")
+        elif not refresh_worker.refreshable():
+            st.error(f'No data, there is no export at {etl.EXPORT_PATH}')
+        else:
+            st.error('No data yet, the first refresh of the export is still running')
+        st.stop()
 
 # app code
-large_donations_by_category, large_spending_by_category, donations_below_large_by_category, spending_below_large_by_category, \
-        donations_total, spending_total, donations_total_by_category, spending_total_by_category = etl.read_txs()
-
+data_prep()
+# amounts are shown in the selected currency, the converted datasets are cached across reruns
+value = st.sidebar.selectbox('Currency', currency.available())
+if value == 'UAH' and currency.rates_path() is None:
+    st.sidebar.caption(f'USD/EUR need a daily FX table at {currency.FX_PATHS[-1]}')
+cube = currency.converted('rollup_cube', value)
+
+refresh_status = refresh_worker.read_status()
+if refresh_status['last_refresh']:
+    st.sidebar.caption(f"Last refresh: {refresh_status['last_refresh']} in {refresh_status['duration']:.1f}s")
+st.sidebar.caption(f"Dataset cache: {etl.dataset_stats['hits']} hits / {etl.dataset_stats['misses']} misses")
+st.sidebar.caption(f"Currency cache: {currency.converted_stats['hits']} hits / {currency.converted_stats['misses']} misses, "
+                   f"analytics cache: {analytics.cache_stats['hits']} hits / {analytics.cache_stats['misses']} misses")
+st.sidebar.caption(f"Figure cache: {charting_tools.figure_cache_stats['hits']} hits / {charting_tools.figure_cache_stats['misses']} misses, "
+                   f"{charting_tools.figure_cache_stats['bytes'] / 2**20:.1f} MB")
+
+downsample = st.sidebar.checkbox('Downsample long charts', value=True)
+payload = {'sent': 0, 'saved': 0}
+
+# the sections lay out their widgets and placeholders right away, their data and figures are
+# built concurrently in the pool and every placeholder is filled as soon as its section is done.
+# The builds hold the GIL for much of their time, more threads than cores only interleave them
+SECTION_WORKERS = min(4, os.cpu_count() or 1)
+pool = ThreadPoolExecutor(SECTION_WORKERS)
+pending = {}
+section_times = {}
+
+def build_section(name, build):
+    """ run a section build in a pool thread, profiled into its own records when the page is"""
+    if debug:
+        profiling.start()
+    start = time.perf_counter()
+    with profiling.section(name):
+        result = build()
+    return result, time.perf_counter() - start, profiling.stop() if debug else []
+
+def run_section(name, build, fill):
+    """ submit the build of a section, fill renders its result from the script thread"""
+    pending[pool.submit(build_section, name, build)] = (name, fill)
+
+def fill_sections():
+    """ fill the placeholders in the order the sections finish"""
+    for future in as_completed(pending):
+        name, fill = pending[future]
+        result, seconds, records = future.result()
+        section_times[name] = seconds
+        profiling.extend(records)
+        fill(result)
+    pool.shutdown()
+
+def placeholder():
+    slot = st.empty()
+    slot.caption('Loading...')
+    return slot
+
+def prepare(fig):
+    """ plotly chart and the bytes saved on it, long charts are downsampled to the chart width when enabled"""
+    if not downsample:
+        return fig, 0
+    small = charting_tools.downsample_figure(fig)
+    return small, charting_tools.payload_bytes(fig) - charting_tools.payload_bytes(small)
+
+def plot(slot, fig, saved = 0):
+    payload['saved'] += saved
+    payload['sent'] += charting_tools.payload_bytes(fig)
+    with profiling.section('st.plotly_chart'):
+        slot.plotly_chart(fig, use_container_width=True)
+
+page_start = time.perf_counter()
 st.title("Dignitas Fund **Financials**")
 
-def show_metrics(donations_total, spending_total):
-    """ Show metrics"""
-    #end_date = df['Date'].max()
-    starting_date = dt.date(2023, 2, 15)
-    end_date = dt.date.today()
-    #dt.date(2023, 10, 31)
-
-    #donations_today = etl.format_money(donations_total[donations_total['Date'] == donations_total['Date'].max()]['UAH'].iloc[0])
-    spending_latest = etl.format_money(spending_total[spending_total['Date'] == spending_total['Date'].max()]['UAH'].iloc[0])
-    yesterday = donations_total['Date'].max() #- pd.Timedelta(days=1)
-    donations_yesterday = etl.format_money(donations_total[donations_total['Date'] == yesterday]['UAH'].sum())#.iloc[0])
-
+@profiling.profiled
+def show_metrics(kpis):
+    """ Show metrics from the KPI snapshot of the ETL, the deltas are the latest day with transactions"""
+    donations, spending = kpis['donations'], kpis['spending']
     col1, col2, col3 = st.columns(3)
-    col1.metric("Days", (end_date - starting_date).days, "1", delta_color="normal")
-    col2.metric("Donations", etl.format_money(donations_total.UAH.sum()), donations_yesterday, delta_color="normal")
-    col3.metric("Spending",  etl.format_money(spending_total.UAH.sum()),  spending_latest, delta_color="normal")
+    col1.metric("Days", etl.days_since_launch(), "1", delta_color="normal")
+    col2.metric(f"Donations, {value}", etl.format_money(donations['total']), etl.format_money(donations['latest_day']['total']), delta_color="normal")
+    col3.metric(f"Spending, {value}",  etl.format_money(spending['total']),  etl.format_money(spending['latest_day']['total']), delta_color="normal")
 
-show_metrics(donations_total, spending_total)
+show_metrics(currency.converted('kpis', value))
 
 
-def show_donations_spending(spending_total, donations_total):
+def show_donations_spending(cube):
     """ Show donations and spending by time period"""
 
     col0, col1, col2, col3 = st.columns(4)
@@ -83,96 +153,56 @@ def show_donations_spending(spending_total, donations_total):
         timespan = st.selectbox(' ',['Since launch ', '1 Year ', '1 Month ', '3 Months ', '6 Months '],
                                 index=['Since launch ', '1 Year ', '1 Month ', '3 Months ', '6 Months '].index(st.session_state.timespan))
 
-    spending = da.sum_by_period(spending_total, timeperiod[0])
-    donations = da.sum_by_period(donations_total, timeperiod[0])
-
-    if not isinstance(donations.index, pd.core.indexes.period.PeriodIndex):
-        donations.index = donations.index.to_period(timeperiod[0])
-    if not isinstance(spending.index, pd.core.indexes.period.PeriodIndex):
-        spending.index = spending.index.to_period(timeperiod[0])
-
-    donations_and_spending = pd.merge(donations, spending, left_index=True, right_index=True, how = 'left')
-    donations_and_spending.columns = ['Donations', 'Spending']
+    def build():
+        spending = da.cube_totals(cube, 'spending', 'all', timeperiod[0])
+        donations = da.cube_totals(cube, 'donations', 'all', timeperiod[0])
 
-    if timespan == '1 Month ':
-        donations_and_spending = donations_and_spending.loc[donations_and_spending.index > (pd.Timestamp.now() - pd.DateOffset(months=1)).strftime("%Y-%m-%d")]
-    elif timespan == '3 Months ':
-        donations_and_spending = donations_and_spending.loc[donations_and_spending.index > (pd.Timestamp.now() - pd.DateOffset(months=3)).strftime("%Y-%m")]
-    elif timespan == '6 Months ':
-        donations_and_spending = donations_and_spending.loc[donations_and_spending.index > (pd.Timestamp.now() - pd.DateOffset(months=6)).strftime("%Y-%m")]
-    elif timespan == '1 Year ':
-        donations_and_spending = donations_and_spending.loc[donations_and_spending.index > (pd.Timestamp.now() - pd.DateOffset(years=1)).strftime("%Y")]
+        donations_and_spending = pd.merge(donations, spending, left_index=True, right_index=True, how = 'left')
+        donations_and_spending.columns = ['Donations', 'Spending']
+        donations_and_spending = da.date_window(donations_and_spending, timespan)
 
-    donations_and_spending.index = donations_and_spending.index.to_timestamp()
+        return prepare(charting_tools.bar_plot_grouped(donations_and_spending, 'Donations', 'Spending', '', False))
 
-    fig = charting_tools.bar_plot_grouped(donations_and_spending, 'Donations', 'Spending', '', False)
-    st.plotly_chart(fig, use_container_width=True)
+    slot = placeholder()
+    run_section('show_donations_spending', build, lambda result: plot(slot, *result))
 
-show_donations_spending(spending_total, donations_total)
+show_donations_spending(cube)
 
 # Ring plot - Donations and Spending by Category
-def show_donations_spending_by_category(large_donations_by_category, large_spending_by_category,
-                                        donations_below_large_by_category, spending_below_large_by_category,
-                                        donations_total_by_category, spending_total_by_category):
+def show_donations_spending_by_category(cube):
     """ Show donations and spending by category"""
-    donations_by_category = donations_total_by_category
-    spending_by_category = spending_total_by_category
-
     col0, col1, col2, col3 = st.columns(4)
     with col0:
         over_below_all = st.selectbox(' ',['all txs', 'over 100K', 'below 100K'])
     with col3:
         period = st.selectbox(' ', ['Month', 'Week', 'Day', 'Year'])
 
-    if period == 'Month':
-        donations = donations_by_category[donations_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(months=1)]
-        spending =  spending_by_category[spending_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(months=1)]
-
-    elif period == 'Week':
-        donations = donations_by_category[donations_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(weeks=1)]
-        spending =  spending_by_category[spending_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(weeks=1)]
-    elif period == 'Day':
-        day = donations_by_category['Date'].max()
-        donations = donations_by_category[donations_by_category['Date'] == donations_by_category.Date.max()]
-        spending =  spending_by_category[spending_by_category['Date'] == spending_by_category.Date.max()]
-    elif period == 'Year':
-        donations = donations_by_category[donations_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(years=1)]
-        spending =  spending_by_category[spending_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(years=1)]
-    else:
-        donations = donations_by_category
-        spending = spending_by_category
-
-    if over_below_all == 'over 100K':
-        donations = donations[donations['UAH'] >= 100000]
-        spending = spending[spending['UAH'] >= 100000]
-    elif over_below_all == 'below 100K':
-        donations = donations[donations['UAH'] < 100000]
-        spending = spending[spending['UAH'] < 100000]
-    # else:
-    #     donations = donations_total_by_category
-    #     spending = spending_total_by_category
-
-    donations_by_cat = pd.DataFrame(donations.groupby('Category')['UAH'].sum())
-    spending_by_cat =  pd.DataFrame(spending.groupby('Category')['UAH'].sum())
-
-    fig1 = charting_tools.pie_plot(donations_by_cat, 'UAH', 'Donations by category', False)
-    fig2 = charting_tools.pie_plot(spending_by_cat, 'UAH', "Spending by Category", False)
-    fig = charting_tools.subplot_horizontal(fig1, fig2, 1, 2, 'domain', 'domain', 'Donations by Category', 'Spending by Category', False)
-    st.plotly_chart(fig, use_container_width=True)
-
-show_donations_spending_by_category(large_donations_by_category, large_spending_by_category,
-                                    donations_below_large_by_category, spending_below_large_by_category,
-                                    donations_total_by_category, spending_total_by_category)
-
-def donations_spending_by_period_by_category(donations_total_by_category, spending_total_by_category,
-                                            large_donations_by_category, large_spending_by_category,
-                                            donations_below_large_by_category, spending_below_large_by_category):
-    """Donations/Spending by time period (d, w, m) and large/regular amounts"""
-    #main_donation_categories = donations_total_by_category.groupby('Category')['UAH'].sum().sort_values(ascending = False).index[:4].tolist()
-    main_donation_categories = donations_total_by_category.groupby('Category')['UAH'].sum().sort_values(ascending=False).index.tolist()
-    #main_spending_categories = spending_total_by_category.groupby('Category')['UAH'].sum().sort_values(ascending = False).index[:4].tolist()
-    main_spending_categories = spending_total_by_category.groupby('Category')['UAH'].sum().sort_values(ascending = False).index.tolist()
+    def build():
+        size = {'all txs': 'all', 'over 100K': 'large', 'below 100K': 'below'}[over_below_all]
+        donations_by_category = da.cube_slice(cube, 'donations', size, 'D')
+        spending_by_category = da.cube_slice(cube, 'spending', size, 'D')
+
+        donations = da.date_window(donations_by_category, period)
+        spending = da.date_window(spending_by_category, period)
 
+        donations_by_cat = pd.DataFrame(donations.groupby('Category')[value].sum())
+        spending_by_cat =  pd.DataFrame(spending.groupby('Category')[value].sum())
+
+        fig1 = charting_tools.pie_plot(donations_by_cat, value, 'Donations by category', False)
+        fig2 = charting_tools.pie_plot(spending_by_cat, value, "Spending by Category", False)
+        return charting_tools.subplot_horizontal(fig1, fig2, 1, 2, 'domain', 'domain', 'Donations by Category', 'Spending by Category', False)
+
+    def fill(fig):
+        with profiling.section('st.plotly_chart'):
+            slot.plotly_chart(fig, use_container_width=True)
+
+    slot = placeholder()
+    run_section('show_donations_spending_by_category', build, fill)
+
+show_donations_spending_by_category(cube)
+
+def donations_spending_by_period_by_category(cube):
+    """Donations/Spending by time period (d, w, m) and large/regular amounts"""
     col0, col1, col2, col3 = st.columns(4)
     with col0:
         amount = st.selectbox(' ',['<100K', '>100K', 'all txs'])
@@ -183,37 +213,68 @@ def donations_spending_by_period_by_category(donations_total_by_category, spendi
     with col3:
         timespan = st.selectbox(' ',[ 'All time', '1 Month', '3 Months', '1 Year'])
 
-    if amount == '>100K':
-        donations_by_category = large_donations_by_category
-        spending_by_category = large_spending_by_category
-    elif amount == '<100K':
-        donations_by_category = donations_below_large_by_category
-        spending_by_category = spending_below_large_by_category
-    else:
-        donations_by_category = donations_total_by_category
-        spending_by_category = spending_total_by_category
-
-    if donations_spending == 'Donations ':
-        main_categories = main_donation_categories
-        tx_by_category = donations_by_category
-    else:
-        main_categories = main_spending_categories
-        tx_by_category = spending_by_category
-
-    if timespan == '1 Month':
-        tx_by_category = tx_by_category[tx_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(months=1)]
-    elif timespan == '3 Month':
-        tx_by_category = tx_by_category[tx_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(months=3)]
-    elif timespan == '1 Year':
-        tx_by_category = tx_by_category[tx_by_category['Date'] >= pd.Timestamp.now().floor('D') - pd.DateOffset(years=1)]
-
-    fig = charting_tools.chart_by_period(tx_by_category, main_categories, selected_period[0],
-                                        f'{selected_period} {amount} {donations_spending} over {timespan}')
-    st.plotly_chart(fig, use_container_width=True)
-
-donations_spending_by_period_by_category(donations_total_by_category, spending_total_by_category,
-                                                                        large_donations_by_category, large_spending_by_category,
-                                                                        donations_below_large_by_category, spending_below_large_by_category)
+    def build():
+        #main_donation_categories = donations_total_by_category.groupby('Category')['UAH'].sum().sort_values(ascending = False).index[:4].tolist()
+        #main_spending_categories = spending_total_by_category.groupby('Category')['UAH'].sum().sort_values(ascending = False).index[:4].tolist()
+        size = {'>100K': 'large', '<100K': 'below', 'all txs': 'all'}[amount]
+
+        if donations_spending == 'Donations ':
+            kind = 'donations'
+        else:
+            kind = 'spending'
+        main_categories = da.cube_slice(cube, kind, 'all', 'Y').groupby('Category')[value].sum().sort_values(ascending=False).index.tolist()
+
+        tx_by_category = da.date_window(da.cube_slice(cube, kind, size, selected_period[0]), timespan)
+
+        return prepare(charting_tools.chart_by_period(tx_by_category, main_categories, selected_period[0],
+                                                      f'{selected_period} {amount} {donations_spending} over {timespan}', value))
+
+    slot = placeholder()
+    run_section('donations_spending_by_period_by_category', build, lambda result: plot(slot, *result))
+
+donations_spending_by_period_by_category(cube)
+
+def show_trends():
+    """Rolling daily means of donations and spending and the runway per category"""
+    col0, col1, col2, col3 = st.columns(4)
+    with col0:
+        window = st.selectbox(' ', ['30 days', '7 days', '90 days'])
+    days = int(window.split()[0])
+
+    def build():
+        trends = analytics.trends(value)
+        burn = analytics.burn_rate(value, days).iloc[-1]
+        fig = charting_tools.trend_plot(trends, [f'Donations {days}d mean', f'Spending {days}d mean'],
+                                        f'Daily donations and spending, {window} mean')
+
+        runway = analytics.runway(value, days)
+        table = pd.DataFrame({
+            'Balance': etl.format_money_vec(runway['Balance']),
+            'Spent a day': etl.format_money_vec(runway['Daily burn']),
+            'Runway, days': runway['Runway days'].map(lambda runway_days: '∞' if runway_days == float('inf') else f'{runway_days:.0f}').to_numpy(),
+        }, index=runway.index)
+        return prepare(fig), burn, table
+
+    def fill(result):
+        (fig, saved), burn, table = result
+        plot(slot, fig, saved)
+        burn_slot.caption(f"Last {window}: {etl.format_money(burn['Spending'])} spent of {etl.format_money(burn['Donations'])} "
+                          f"donated, burn rate {burn['Burn rate']:.0%}")
+        table_slot.dataframe(table)
+
+    slot = placeholder()
+    burn_slot = st.empty()
+    table_slot = st.empty()
+    run_section('show_trends', build, fill)
+
+show_trends()
+
+fill_sections()
+page_seconds = time.perf_counter() - page_start
+
+st.sidebar.caption(f"Chart payload: {payload['sent'] / 1024:.0f} KB sent, {payload['saved'] / 1024:.0f} KB saved by downsampling")
+st.sidebar.caption(f"Sections: {page_seconds * 1000:.0f} ms page, {sum(section_times.values()) * 1000:.0f} ms summed over "
+                   + ', '.join(f'{name} {seconds * 1000:.0f}' for name, seconds in section_times.items()))
 
 st.markdown("<br>", unsafe_allow_html=True)
 # Donate button
@@ -227,4 +288,12 @@ if col2.button("Donate", key="donate_button", help="Click to donate"):
 st.write("---")
 col1, col2, col3, col4 = st.columns(4)
 with col1: st.markdown("[Dignitas Fund Site](https://dignitas.fund/uk)")
-with col4: st.markdown(f"[{'Contact'}](mailto:{'info@dignitas.fund'})")
\ No newline at end of file
+with col4: st.markdown(f"[{'Contact'}](mailto:{'info@dignitas.fund'})")
+
+if debug:
+    records = profiling.stop()
+    with st.expander('Profile of this run'):
+        st.dataframe(profiling.summary(records))
+        col1, col2 = st.columns(2)
+        col1.download_button('JSON', profiling.to_json(records), file_name='profile.json')
+        col2.download_button('Flamegraph (folded stacks)', profiling.to_folded(records), file_name='profile.folded')
@@ -1,247 +1,969 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 #import import_ipynb
 import data_aggregation_tools as da
+import category_rules
+import profiling
+import argparse
+import contextlib
+import fcntl
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+EXPORT_PATH = './data/ExportEN.csv'
+STATE_PATH = 'data/etl_state.json'
+# hashes of the processed spending rows, a repeated row is dropped in later runs as well
+SPENDING_HASHES_PATH = 'data/etl_spending_hashes.npy'
+# held while the outputs and the state are written, by one process or thread at a time
+LOCK_PATH = 'data/etl.lock'
+DATASET_PATH = 'data/txs.parquet'
+CUBE_PATH = 'data/rollup_cube'
+KPI_PATH = 'data/kpis.json'
+LAUNCH_DATE = '2023-02-15'
+# trailing windows of the KPI snapshot in days, ending on the latest day with transactions
+KPI_WINDOWS = {'latest_day': 1, 'last_7_days': 7, 'last_30_days': 30}
+STORAGE_FORMAT = 'arrow'
+TRANSACTIONS_PATH = 'data/transactions'
+CHUNKSIZE = 100000
+# aggregated outputs are bucketed to this grain, None keeps one row per transaction timestamp
+GRAIN = 'D'
+# how each aggregate column folds when outputs are merged or rolled up
+AGGREGATIONS = {'UAH': 'sum', 'Count': 'sum', 'Min': 'min', 'Max': 'max'}
+EXPORT_DTYPES = { 'UAH': 'float', 'To Account': 'category', 'From Account': 'category', 'Category': 'category', 'Subcategory': 'category',
+                  'Commentary': 'string[pyarrow]'}
+# export columns kept as categoricals, their dictionary is the set of values in the export
+CATEGORICAL_COLUMNS = ['To Account', 'From Account', 'Category', 'Subcategory']
+# transactions at or above this many UAH are large
+LARGE_AMOUNT = 100000
+
+# pipeline outputs in the order returned by read_txs
+OUTPUTS = ['large_donations_by_category', 'large_spending_by_category',
+           'donations_below_large_by_category', 'spending_below_large_by_category',
+           'donations_total', 'spending_total', 'donations_total_by_category', 'spending_total_by_category']
+
+# (kind, size) partition of the parquet dataset holding each by-category output,
+# the totals are rolled up from the 'all' partitions on read
+PARTITIONS = {
+    'large_donations_by_category': ('donations', 'large'),
+    'large_spending_by_category': ('spending', 'large'),
+    'donations_below_large_by_category': ('donations', 'below'),
+    'spending_below_large_by_category': ('spending', 'below'),
+    'donations_total_by_category': ('donations', 'all'),
+    'spending_total_by_category': ('spending', 'all'),
+}
+
+_fingerprints = {}
+_compiled_rules = {}
+_donor_cache = {}
+datasets = {}
+dataset_stats = {'hits': 0, 'misses': 0}
+_dataset_lock = threading.Lock()
+_publisher = None
 
 def format_money(value):
-    if abs(value) >= 1e6:
-        return '{:.2f}M'.format(value / 1e6)
-    elif abs(value) >= 1e3:
-        return '{:.2f}K'.format(value / 1e3)
+    return str(format_money_vec([value])[0])
+
+def format_money_vec(values):
+    """format_money over a whole Series/array, returns an array of strings"""
+    values = np.asarray(values, dtype=float).ravel()
+    magnitude = np.abs(values)
+    tier = (magnitude >= 1e3).astype(np.int64) + (magnitude >= 1e6)
+    scaled = values / 1000.0**tier
+
+    # whole cents in integer arithmetic, values next to a half cent, huge or not finite go through printf rounding
+    cents = np.abs(scaled) * 100
+    with np.errstate(invalid='ignore'):
+        exact = (cents < 2**52) & (np.abs(cents - np.floor(cents) - 0.5) > 1e-6)
+    cents = np.rint(np.where(exact, cents, 0)).astype(np.int64)
+    units = cents // 100
+    sign = np.signbit(scaled) & exact
+
+    # one row of code points per label '-123.45K', the trailing zeros are dropped by the unicode dtype
+    width = np.ones(len(values), dtype=np.int64)
+    for power in range(1, 16):
+        width += units >= 10**power
+    end = sign + width
+    size = int(end.max(initial=0)) + 4
+    chars = np.zeros((len(values), size), dtype=np.uint32)
+    rows = np.arange(len(values))
+    chars[rows, 0] = np.where(sign, ord('-'), 0)
+    for power in range(int(width.max(initial=1))):
+        has = width > power
+        chars[rows[has], end[has] - 1 - power] = ord('0') + units[has] // 10**power % 10
+    chars[rows, end] = ord('.')
+    chars[rows, end + 1] = ord('0') + cents // 10 % 10
+    chars[rows, end + 2] = ord('0') + cents % 10
+    chars[rows, end + 3] = np.array([0, ord('K'), ord('M')])[tier]
+    text = chars.view(f'U{size}').ravel()
+
+    if not exact.all():
+        text = text.astype(object)
+        text[~exact] = np.char.add(np.char.mod('%.2f', scaled[~exact]), np.array(['', 'K', 'M'])[tier[~exact]])
+    return text
+
+def read_txs(fmt = None):
+    return tuple(get_dataset(name, fmt) for name in OUTPUTS)
+
+def read_dataset(kind = None, size = None, columns = None, start = None, end = None):
+    """Read the parquet dataset, pruning partitions by kind/size and row groups by Date range"""
+    filters = []
+    if kind:
+        filters.append(('kind', '==', kind))
+    if size:
+        filters.append(('size', '==', size))
+    if start is not None:
+        filters.append(('Date', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('Date', '<=', pd.Timestamp(end)))
+
+    return pd.read_parquet(DATASET_PATH, columns=columns, filters=filters or None)
+
+def dataset_files(name, fmt = None):
+    """Files a dataset is read from, the totals are rolled up from the by-category partition"""
+    fmt = fmt or STORAGE_FORMAT
+    if name == 'kpis':
+        return [KPI_PATH]
+    if name == 'rollup_cube':
+        return [f'{CUBE_PATH}.{fmt}']
+    if fmt in ('csv', 'arrow'):
+        return [f'data/{name}.{fmt}']
+    kind, size = PARTITIONS.get(name) or PARTITIONS[f'{name}_by_category']
+    return [f'{DATASET_PATH}/kind={kind}/size={size}']
+
+def dataset_stamp(name, fmt = None):
+    """mtime and size of the files of a dataset, a rewrite changes the stamp"""
+    stamp = []
+    for path in dataset_files(name, fmt):
+        if os.path.isdir(path):
+            stamp.extend((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in os.scandir(path))
+        else:
+            stat = os.stat(path)
+            stamp.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(stamp))
+
+@profiling.profiled
+def load_dataset(name, fmt = None):
+    fmt = fmt or STORAGE_FORMAT
+    if name == 'kpis':
+        return read_kpis()
+    if name == 'rollup_cube':
+        return read_cube(fmt)
+    if fmt == 'csv':
+        data = pd.read_csv(f'data/{name}.csv', dtype={'UAH': 'float', 'Category': 'str'}, keep_default_na=False, parse_dates=['Date'])
+    elif fmt == 'arrow':
+        data = read_arrow(f'data/{name}.arrow')
+    elif name in PARTITIONS:
+        data = read_dataset(*PARTITIONS[name]).drop(['kind', 'size'], axis=1)
     else:
-        return '{:.2f}'.format(value)
-
-def read_txs():
-    dtypes = { 'UAH': 'float', 'Category': 'str' }
-
-    large_donations_by_category = pd.read_csv('data/large_donations_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-    large_spending_by_category = pd.read_csv('data/large_spending_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-
-    donations_below_large_by_category = pd.read_csv('data/donations_below_large_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-    spending_below_large_by_category = pd.read_csv('data/spending_below_large_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-
-    donations_total = pd.read_csv('data/donations_total.csv', dtype=dtypes, parse_dates=['Date'])
-    spending_total =  pd.read_csv('data/spending_total.csv', dtype=dtypes, parse_dates=['Date'])
-
-    donations_total_by_category = pd.read_csv('data/donations_total_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-    spending_total_by_category = pd.read_csv('data/spending_total_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-
-    donations_total_by_category = pd.read_csv('data/donations_total_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-    spending_total_by_category = pd.read_csv('data/spending_total_by_category.csv', dtype=dtypes, parse_dates=['Date'])
-
-    return large_donations_by_category, large_spending_by_category, donations_below_large_by_category, spending_below_large_by_category, \
-        donations_total, spending_total, donations_total_by_category, spending_total_by_category
-
-
-def read_data(nrows = None):
-    dtypes = { 'UAH': 'float', 'To Account': 'str', 'From Account': 'str', 'Category': 'str', 'Subcategory': 'str', 'Commentary': 'str'}
-
-    if nrows:
-            df = pd.read_csv('./data/ExportEN.csv', dtype=dtypes, nrows=nrows, index_col=None, parse_dates=['Date'])
+        data = rollup(get_dataset(f'{name}_by_category', fmt).drop('Category', axis=1), ['Date'])
+    # sorted by Date for the binary searched window queries, the arrow files are already
+    return data if data['Date'].is_monotonic_increasing else data.sort_values('Date', kind='stable', ignore_index=True)
+
+def get_dataset(name, fmt = None):
+    """A pipeline output or the rollup cube, read on first access and shared until its files change,
+    every session is served from this registry and dataset_stats counts its hits and misses.
+    The frames are shared between sessions and must not be modified"""
+    fmt = fmt or STORAGE_FORMAT
+    stamp = dataset_stamp(name, fmt)
+    with _dataset_lock:
+        cached = datasets.get((name, fmt))
+        if cached and (cached[0] == stamp or (publishing() and _publisher != threading.get_ident())):
+            # while the outputs are being replaced the complete previous version is served
+            dataset_stats['hits'] += 1
+            return cached[1]
+
+    if _publisher != threading.get_ident() and publishing():
+        # nothing to serve yet, wait until the run replacing the outputs is done
+        with publish_lock(shared=True):
+            stamp = dataset_stamp(name, fmt)
+            data = load_dataset(name, fmt)
     else:
-            df = pd.read_csv('./data/ExportEN.csv', dtype=dtypes, index_col=None, parse_dates=['Date'])
-
-    df['Subcategory'] = df['Subcategory'].fillna('')
-    df['Category'] = df['Category'].fillna('')
-
+        data = load_dataset(name, fmt)
+    with _dataset_lock:
+        datasets[(name, fmt)] = (stamp, data)
+        dataset_stats['misses'] += 1
+    return data
+
+def prime_datasets(txs, cube, kpis, fmt = None):
+    """Register freshly written outputs so that the next access doesn't read them back"""
+    fmt = fmt or STORAGE_FORMAT
+    with _dataset_lock:
+        for name, data in list(zip(OUTPUTS, txs)) + [('rollup_cube', cube), ('kpis', kpis)]:
+            datasets[(name, fmt)] = (dataset_stamp(name, fmt), data)
+
+@profiling.profiled
+def publish_txs(txs, fmt = None, kpis = None):
+    """Write the outputs, their rollup cube and the KPI snapshot, built from the outputs
+    unless given, and prime the dataset registry with them"""
+    cube = build_cube(txs)
+    kpis = kpis or build_kpis(txs)
+    save_txs(txs, fmt)
+    save_cube(cube, fmt)
+    save_kpis(kpis)
+    prime_datasets(txs, cube, kpis, fmt)
+
+@contextlib.contextmanager
+def publish_lock(path = LOCK_PATH, shared = False):
+    """Exclusive lock on path for the block: the dashboard's worker, a standalone worker and the
+    ETL command line publish one after the other, a waiting run sees the state left by the other.
+    A shared lock waits for the publish in progress to finish"""
+    global _publisher
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        if shared:
+            yield
+            return
+        _publisher = threading.get_ident()
+        try:
+            yield
+        finally:
+            _publisher = None
+
+def publishing(state_path = STATE_PATH):
+    """True while a run is replacing the outputs, or when one was interrupted doing so"""
+    state = read_state(state_path)
+    return bool(state and state.get('publishing'))
+
+def replace_file(path, write):
+    """Call write with a temp path and swap the result in with os.replace, readers see the old
+    or the new file but never a partial one"""
+    write(f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+
+def replace_dir(path, write):
+    """Call write with a new directory and swap it in by repointing the symlink at path, readers
+    see the old or the new dataset but never a partial one. The previous directory is kept for
+    the readers still listing it, older ones are removed"""
+    target = f'{path}.{time.time_ns()}'
+    write(target)
+    previous = os.readlink(path) if os.path.islink(path) else None
+    if os.path.isdir(path) and previous is None:
+        # a dataset written in place before the symlink
+        shutil.rmtree(path)
+    if os.path.lexists(f'{path}.tmp'):
+        os.remove(f'{path}.tmp')
+    os.symlink(os.path.basename(target), f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+    keep = {os.path.basename(target), previous}
+    for old in glob.glob(f'{glob.escape(path)}.*'):
+        if os.path.basename(old) not in keep and os.path.isdir(old) and not os.path.islink(old):
+            shutil.rmtree(old)
+
+def write_arrow(data, path):
+    """Write a frame as an uncompressed Arrow IPC file. The file is replaced, not rewritten in place,
+    so readers that have the previous version mapped keep a valid copy"""
+    table = pa.Table.from_pandas(data, preserve_index=False)
+
+    def write(tmp):
+        with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    replace_file(path, write)
+
+def read_arrow(path):
+    """Memory-mapped Arrow IPC file as a frame. The column buffers are not copied, they are pages of
+    the file shared by every process that maps it. Strings included, as pandas' str dtype is arrow-backed"""
+    return pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas(split_blocks=True)
+
+def save_txs(txs, fmt = None):
+    """Write the pipeline outputs as data/<name>.arrow or data/<name>.csv files,
+    or as one parquet dataset partitioned by kind and size"""
+    fmt = fmt or STORAGE_FORMAT
+    if fmt == 'csv':
+        for name, data in zip(OUTPUTS, txs):
+            replace_file(f'data/{name}.csv', lambda tmp: data.to_csv(tmp, index=False))
+        return
+    if fmt == 'arrow':
+        for name, data in zip(OUTPUTS, txs):
+            write_arrow(data, f'data/{name}.arrow')
+        return
+
+    txs = dict(zip(OUTPUTS, txs))
+    parts = []
+    for name, (kind, size) in PARTITIONS.items():
+        parts.append(txs[name].assign(kind=kind, size=size))
+    data = pd.concat(parts, ignore_index=True)
+    data['Category'] = data['Category'].fillna('').astype('category')
+    data['UAH'] = data['UAH'].astype('float64')
+    replace_dir(DATASET_PATH, lambda tmp: data.to_parquet(tmp, partition_cols=['kind', 'size'], index=False))
+
+def to_kopiykas(uah):
+    """UAH amounts as exact integer kopiykas, nullable Int64 when some are missing"""
+    kopiykas = np.round(uah.to_numpy(dtype='float64') * 100)
+    if np.isnan(kopiykas).any():
+        return pd.array(kopiykas, dtype='Int64')
+    return kopiykas.astype('int64')
+
+def fill_blank(column):
+    """Missing values of a categorical column as ''"""
+    if '' not in column.cat.categories:
+        column = column.cat.add_categories('')
+    return column.fillna('')
+
+def compact_export(df):
+    """Export rows with blank categories filled and the UAH replaced by Kopiykas"""
+    df['Subcategory'] = fill_blank(df['Subcategory'])
+    df['Category'] = fill_blank(df['Category'])
+    df.insert(df.columns.get_loc('UAH'), 'Kopiykas', to_kopiykas(df.pop('UAH')))
     return df
 
-def convert_to_USD(df, UA_USD_exchange_rate):
-    df['UAH'] = df['UAH']/UA_USD_exchange_rate
+@profiling.profiled
+def read_data(nrows = None, path = EXPORT_PATH):
+    """Read the export: categorical accounts and categories, arrow string Commentary, integer Kopiykas"""
+    if nrows:
+            df = pd.read_csv(path, dtype=EXPORT_DTYPES, nrows=nrows, index_col=None, parse_dates=['Date'])
+    else:
+            df = pd.read_csv(path, dtype=EXPORT_DTYPES, index_col=None, parse_dates=['Date'])
+
+    return compact_export(df)
+
+def read_data_chunks(path = EXPORT_PATH, chunksize = CHUNKSIZE):
+    """Read the export chunksize rows at a time"""
+    for df in pd.read_csv(path, dtype=EXPORT_DTYPES, chunksize=chunksize, index_col=None, parse_dates=['Date']):
+        yield compact_export(df)
+
+def union_categories(parts):
+    """Frames with the categorical columns recoded to one shared dictionary, so they concatenate as categoricals"""
+    categories = {col: pd.api.types.union_categoricals([part[col] for part in parts]).categories
+                  for col in CATEGORICAL_COLUMNS}
+    return [part.astype({col: pd.CategoricalDtype(values) for col, values in categories.items()}) for part in parts]
+
+def read_export_keyed(path):
+    """read_data with a row key: the hash of the row and its occurrence number within the file"""
+    df = read_data(path=path)
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    df['row_hash'] = hashes.to_numpy()
+    df['row_nth'] = hashes.groupby(hashes.to_numpy()).cumcount().to_numpy()
     return df
 
-def replace_category(data, column, value):
-    """Replace Category with Subcategory"""
-    df_copy = data.copy()  # Create a copy of the DataFrame to avoid modifying the original
-    df_copy.loc[df_copy[column] == value, 'Category'] = df_copy['Subcategory']
-    return df_copy
-
-def replace_category_values(data, category_column, val1, val2):
-    """Mapping of Category values"""
-    df_copy = data.copy()
-    df_copy[category_column] = df_copy[category_column].replace(val1, val2)
-    return df_copy
+@profiling.profiled
+def read_exports(paths, workers = None):
+    """Parse the export files across a process pool and concatenate them by Date. A row exported
+    in several files is kept as many times as the file repeating it most often has it"""
+    if len(paths) == 1:
+        parts = [read_export_keyed(paths[0])]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            parts = list(pool.map(read_export_keyed, paths))
+    df = pd.concat(union_categories(parts), ignore_index=True)
+    df = df[~df.duplicated(['row_hash', 'row_nth'])].drop(['row_hash', 'row_nth'], axis=1)
+    return df.sort_values('Date', kind='stable').reset_index(drop=True)
+
+def run_etl(paths, workers = None, save = True, state_path = STATE_PATH):
+    """ETL over many export files, returns the outputs and the seconds of every stage.
+    Saving also writes a state listing the exports, so the refresh worker keeps serving
+    and rebuilding these outputs instead of replacing them with those of a single export"""
+    timings = {}
+    stage_start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal stage_start
+        now = time.perf_counter()
+        timings[stage] = now - stage_start
+        stage_start = now
+
+    df = read_exports(paths, workers)
+    lap('parse + dedupe')
+    donations, spending = categorize_txs(df)
+    lap('categorize')
+    txs = aggregate_txs(donations, spending)
+    lap('aggregate')
+    if save:
+        with publish_lock():
+            mark_publishing(read_state(state_path), state_path)
+            publish_txs(txs)
+            save_transactions(donations, spending)
+            save_spending_hashes(drop_seen_spending(df, np.array([], dtype='uint64'))[1])
+            write_sources_state(paths, df['Date'].max(), len(df), state_path)
+        lap('publish')
+    return txs, timings
 
-def extract_relevant_txs(df, start_date, end_date):
-    """Main category mapping module"""
+def convert_to_USD(df, UA_USD_exchange_rate):
+    """Copy of df with a USD column at one fixed rate, currency.convert applies the daily rates"""
+    return df.assign(USD=df['UAH'] / UA_USD_exchange_rate)
+
+def source_fingerprint(path = EXPORT_PATH):
+    """Content hash of the export, re-hashed only when its mtime or size changes"""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _fingerprints.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    _fingerprints[path] = (stamp, digest.hexdigest())
+    return digest.hexdigest()
+
+@profiling.profiled
+def build_cube(txs):
+    """Rollup cube of the by-category outputs: day/week/month/year x category x size x kind"""
+    txs = dict(zip(OUTPUTS, txs))
+    return da.rollup_cube({partition: txs[name] for name, partition in PARTITIONS.items()})
+
+def save_cube(cube, fmt = None):
+    fmt = fmt or STORAGE_FORMAT
+    if fmt == 'csv':
+        replace_file(f'{CUBE_PATH}.csv', lambda tmp: cube.reset_index().to_csv(tmp, index=False))
+    elif fmt == 'arrow':
+        write_arrow(cube.reset_index(), f'{CUBE_PATH}.arrow')
+    else:
+        replace_file(f'{CUBE_PATH}.parquet', lambda tmp: cube.reset_index().to_parquet(tmp, index=False))
+
+def read_cube(fmt = None):
+    fmt = fmt or STORAGE_FORMAT
+    if fmt == 'csv':
+        cube = pd.read_csv(f'{CUBE_PATH}.csv', dtype={'UAH': 'float', 'Category': 'str'}, keep_default_na=False, parse_dates=['Date'])
+    elif fmt == 'arrow':
+        cube = read_arrow(f'{CUBE_PATH}.arrow')
+    else:
+        cube = pd.read_parquet(f'{CUBE_PATH}.parquet')
+    cube = cube.set_index(['kind', 'size', 'level', 'Date', 'Category'])['UAH']
+    # saved sorted, the check spares a copy of the values
+    return cube if cube.index.is_monotonic_increasing else cube.sort_index()
+
+def compile_rules(side):
+    """Compile the rule table of a side into the passes run by apply_rules"""
+    if side in _compiled_rules:
+        return _compiled_rules[side]
+
+    rules = pd.DataFrame(category_rules.RULES, columns=category_rules.RULE_COLUMNS)
+    rules = rules[rules['side'] == side].sort_values('priority', kind='stable')
+    commentary = rules[rules['match'] == 'commentary']
+    keyed = rules[rules['match'] != 'commentary']
+    if len(commentary) and len(keyed) and keyed['priority'].max() >= commentary['priority'].min():
+        raise ValueError(f'{side} commentary rules must have the highest priorities')
+
+    # rules on Category/Subcategory/account run over the unique key combinations,
+    # consecutive account rules are merged into one dictionary lookup
+    passes = []
+    for (match, priority), group in keyed.groupby([keyed['match'], keyed['priority']], sort=False):
+        if match == 'account':
+            passes.append((match, dict(zip(group['pattern'], group['category']))))
+        else:
+            passes.extend((match, (pattern, category)) for pattern, category in zip(group['pattern'], group['category']))
+
+    exclusions = []
+    for _, pattern, case in (rule for rule in category_rules.EXCLUSIONS if rule[0] == side):
+        exclusions.append(re.escape(pattern) if case else f'(?i:{re.escape(pattern)})')
+
+    compiled = {
+        'passes': passes,
+        'exclude': '|'.join(exclusions),
+        'commentary': '|'.join(re.escape(pattern) for pattern in commentary['pattern']),
+        'commentary_rules': list(zip(commentary['pattern'], commentary['category'])),
+    }
+    _compiled_rules[side] = compiled
+    return compiled
+
+def apply_rules(data, side, account):
+    """Category of every row: one pass over the unique (Category, Subcategory, account)
+    keys plus one combined regex pass over the Commentary"""
+    rules = compile_rules(side)
+    key_columns = ['Category', 'Subcategory', account]
+    keys = data[key_columns].drop_duplicates().reset_index(drop=True)
+    codes = data.groupby(key_columns, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    # the passes write values outside the dictionaries of the categorical keys
+    keys = keys.astype(object)
+
+    category = keys['Category']
+    for match, rule in rules['passes']:
+        if match == 'account':
+            category = keys[account].map(rule).fillna(category)
+        elif match == 'subcategory':
+            category = category.where(category != rule[0], keys['Subcategory'])
+        elif match == 'equals':
+            category = category.where(category != rule[0], rule[1])
+        elif match == 'replace':
+            category = category.str.replace(rule[0], rule[1], regex=False)
+        elif match == 'category':
+            category = category.where(~category.str.contains(rule[0], case=False), rule[1])
+    category = category.to_numpy(dtype=object)[codes]
+
+    if rules['commentary']:
+        candidates = np.flatnonzero(data['Commentary'].str.contains(rules['commentary'], case=False, na=False).to_numpy())
+        commentary = data['Commentary'].iloc[candidates]
+        for pattern, target in rules['commentary_rules']:
+            matched = commentary.str.contains(pattern, case=False, regex=False, na=False).to_numpy()
+            category[candidates[matched]] = target
+
+    return pd.Series(category, index=data.index)
+
+@profiling.profiled
+def categorize_txs(df):
+    """Main category mapping module, returns donations and spending with Date, Category and Kopiykas"""
     # spending
     ds = df[df['From Account'].notna()]; ds = ds.drop(['To Account'], axis=1)
 
     # donations
     df = df[df['To Account'].notna()]; df = df.drop(['From Account'], axis=1)
 
-    #if (start_date != None) | (end_date != None):
-    #    df = df[df['Date'] >= start_date]
-    #    ds = ds[ds['Date'] >= start_date]
-        #df = df[df['Date'] <= end_date]
-        #ds = ds[ds['Date'] <= end_date]
-
-    df['Commentary'] = df['Commentary'].astype(str)
-    ds['Commentary'] = ds['Commentary'].astype(str)
-    df = df[~df['Commentary'].str.contains('Переказ між рахунками організації')]
-    ds = ds[~ds['Commentary'].str.contains('Переказ між рахунками організації')]
-    df = df[~df['Commentary'].str.contains('Гривнi вiд продажу')]
-    #ds = ds[~ds['Commentary'].str.contains('Списання коштiв на здiйснення валютно-обмiнних операцiй')]
-    #df = df[df['Category'] != 'Transfer']
-    #ds = ds[ds['Category'] != 'Transfer']
-    #ds = ds[ds['Category'] != 'Продаж валюти']
-    #ds = ds[ds['Category'] != 'Продаж']
+    df = df[~df['Commentary'].str.contains(compile_rules('donations')['exclude'], na=False).to_numpy(dtype=bool)]
+    ds = ds[~ds['Commentary'].str.contains(compile_rules('spending')['exclude'], na=False).to_numpy(dtype=bool)]
     ds = ds.drop_duplicates()
-    ds = ds[~ds['Commentary'].str.contains('продаж', case=False).fillna(False)]
-    ds = ds[~ds['Commentary'].str.contains('списання', case=False).fillna(False)]
-
-    ds = replace_category(ds, 'Category', 'Закупівлі')
-    df = replace_category(df, 'Category', 'Донати')
-    df = replace_category(df, 'Category', 'Гранти')
-    df = replace_category(df, 'Category', 'Income categories')
-    #df = replace_category(df, 'Category', 'Загальні донати')
-
-    old_values = ['Taxes', 'ремонт Авто', 'Юридичні послуги', 'Salary']
-    ds = replace_category_values(ds, 'Category', old_values, 'Адмін')
-
-    df = df.drop(['Subcategory'], axis=1)
-    ds = ds.drop(['Subcategory'], axis=1)
-
-    df['Category'] = df['Category'].str.replace('Адмін Донати', 'Адмін')
-    df['Category'] = df['Category'].str.replace('Донати ', '')
-
-    #mask = (df['To Account'] == 'ПриватБанк Люті пташки')
-    #df.loc[mask, 'Category'] = 'Люті пташки'
-    mask = (df['To Account'] == 'Приват 1000 дронів для України')
-    df.loc[mask, 'Category'] = '1000 дронів для України'
-
-    mask = (df['To Account'] == 'Вікторі Дронс')
-    df.loc[mask, 'Category'] = 'Victory Drones'
-    mask = (df['To Account'] == 'ПриватБанк Загальний рахунок зборів')
-    df.loc[mask, 'Category'] = 'Загальні донати'
-    mask = df['To Account'] == 'Приват Загальний рахунок зборів'
-    df.loc[mask, 'Category'] = 'Загальні донати'
-
-    mask = (df['To Account'] == 'ПриватБанк PLN')
-    df.loc[mask, 'Category'] = 'Загальні донати'
-
-    mask = df['To Account'] == 'ПриватБанк Адмін рахунок'
-    df.loc[mask, 'Category'] = 'Адмін'
-    mask = ds['From Account'] == 'ПриватБанк Адмін рахунок'
-    ds.loc[mask, 'Category'] = 'Адмін'
-
-    mask = df['To Account'] == 'Приват Літай'
-    df.loc[mask, 'Category'] = 'Літай'
-
-    mask = df['To Account'] == 'Приват На захисті краси України'
-    df.loc[mask, 'Category'] = 'На захисті краси України'
-
-    ds['Category'] = ds['Category'].str.replace('техніки Літай', 'Літай')
-    ds['Category'] = ds['Category'].str.replace('Закупівлі на захисті краси', 'На захисті краси України')
-    ds['Category'] = ds['Category'].str.replace('Закупівля ', '')
-    ds['Category'] = ds['Category'].str.replace('Дрони Люті пташки', 'Люті пташки')
-    ds['Category'] = ds['Category'].str.replace('Адміністративні витрати', 'Адмін')
-    df['Category'] = df['Category'].str.replace('Грант МЛПК', 'МЛПК')
-    #df['Category'] = df['Category'].str.replace('бухгалтерські послуги (аудит)', 'Адмін')
-    # ds['Category'] = ds['Category'].str.replace('Канцелярія', 'Адмін')
-    # ds['Category'] = ds['Category'].str.replace('Комісія банку', 'Адмін')
-    # ds['Category'] = ds['Category'].str.replace('обладнання', 'Обладнання')
-
-    mask = ds['From Account'] == 'Приват Банк Адмін рахунок'
-    ds.loc[mask, 'Category'] = 'Адмін'
-    mask = ds['From Account'] == 'Вікторі Дронс'
-    ds.loc[mask, 'Category'] = 'Victory Drones'
-    mask = ds['From Account'] == 'Приват Літай'
-    ds.loc[mask, 'Category'] = 'Літай'
-    mask = ds['From Account'] == 'Приват На захисті краси України'
-    ds.loc[mask, 'Category'] = 'На захисті краси України'
-
-    ds = ds.drop(['From Account'], axis=1)
-    df = df.drop(['To Account'], axis=1)
-
-    condition = ds['Category'].str.contains('|'.join(['Лопати', 'Антени', 'Піротехніка', 'Планшети']), case=False)
-    ds.loc[condition, 'Category'] = 'Лопати + Антени + Піротехніка + Планшети'
-
-    ds['Category'] = ds['Category'].str.replace('Suppliers and Contractors', 'Адмін')
-
-    mask = df['Commentary'].str.contains('люті пташки', case=False, na=False)
-    df.loc[mask, 'Category'] = 'Люті пташки'
-    mask = df['Commentary'].str.contains('MOBILE LAUNDRY SHOWER UNITS', case=False, na=False)
-    df.loc[mask, 'Category'] = 'МЛПК'
-    mask = df['Commentary'].str.contains('From UK ONLINE GIVING FOUNDATION', case=False, na=False)
-    df.loc[mask, 'Category'] = 'Загальні донати'
-    mask = ds['Category'].str.contains('Канцелярія', case=False, na=False)
-    ds.loc[mask, 'Category'] = 'Адмін'
-    mask = ds['Category'].str.contains('обладнання', case=False, na=False)
-    ds.loc[mask, 'Category'] = 'Обладнання'
-    mask = ds['Category'].str.contains('Комісія банку', case=False, na=False)
-    ds.loc[mask, 'Category'] = 'Адмін'
-    mask = ds['Category'].str.contains('бухгалтерські послуги', case=False, na=False)
-    ds.loc[mask, 'Category'] = 'Адмін'
-
-    # save preppped data to csv
-    #df.to_csv('data/donations.csv', index=False)
-    #ds.to_csv('data/spending.csv', index=False)
-    df = df.drop(['Commentary'], axis=1)
-    ds = ds.drop(['Commentary'], axis=1)
-
-    donations_total_by_category = df.groupby(['Date', 'Category']).sum().reset_index()
-    donations_total_by_category.to_csv('data/donations_total_by_category.csv', index=False)
-
-    spending_total_by_category = ds.groupby(['Date', 'Category']).sum().reset_index()
-    spending_total_by_category.to_csv('data/spending_total_by_category.csv', index=False)
-
-    donations_total = df.drop('Category', axis=1).groupby('Date').sum().reset_index()
-
-    donations_total.to_csv('data/donations_total.csv', index=False)
-
-    spending_total = ds.drop('Category', axis=1).groupby('Date').sum().reset_index()
-    spending_total.to_csv('data/spending_total.csv', index=False)
 
-    # above 100k UAH
-    amount = 100000
-    large_donations = df[df['UAH'] >= amount].fillna('')
-    large_donations_by_category = large_donations.groupby(['Date', 'Category']).sum().reset_index()
-    large_donations_by_category.to_csv('data/large_donations_by_category.csv', index=False)
+    df = df.assign(Category=apply_rules(df, 'donations', 'To Account'))
+    ds = ds.assign(Category=apply_rules(ds, 'spending', 'From Account'))
 
-    large_spending = ds[ds['UAH'] >= amount].fillna('')
-    large_spending_by_category = large_spending.groupby(['Date', 'Category']).sum().reset_index()
-    large_spending_by_category.to_csv('data/large_spending_by_category.csv', index=False)
+    df = df.drop(['To Account', 'Subcategory', 'Commentary'], axis=1)
+    ds = ds.drop(['From Account', 'Subcategory', 'Commentary'], axis=1)
 
-    # below 100k UAH
-    donations_below_large_by_category = df[df.UAH < amount]
-    spending_below_large_by_category = ds[ds.UAH < amount]
+    return df, ds
+
+def bucket_dates(dates, grain):
+    """Dates truncated to the start of their grain bucket"""
+    try:
+        return dates.dt.floor(grain)
+    except ValueError:
+        return dates.dt.to_period(grain).dt.start_time
+
+def compact(data, keys, grain):
+    """Transactions grouped by keys, the Kopiykas are summed exactly and returned as UAH.
+    With a grain the Date is bucketed and UAH gets its count, min and max"""
+    if grain is None:
+        sums = data[keys + ['Kopiykas']].groupby(keys, observed=True).sum().reset_index()
+        return sums.assign(Kopiykas=sums['Kopiykas'] / 100).rename(columns={'Kopiykas': 'UAH'})
+
+    buckets = [bucket_dates(data['Date'], grain)] + keys[1:]
+    data = data.groupby(buckets, observed=True)['Kopiykas'].agg(UAH='sum', Count='size', Min='min', Max='max').reset_index()
+    return data.assign(UAH=data['UAH'] / 100, Min=data['Min'] / 100, Max=data['Max'] / 100)
 
-    donations_below_large_by_category = donations_below_large_by_category.groupby(['Date', 'Category']).sum().reset_index()
-    spending_below_large_by_category = spending_below_large_by_category.groupby(['Date', 'Category']).sum().reset_index()
+def rollup(data, keys):
+    """Group already aggregated rows by keys folding every column with its own aggregation"""
+    columns = {col: AGGREGATIONS.get(col, 'sum') for col in data.columns if col not in keys}
+    return data.groupby(keys, observed=True).agg(columns).reset_index()
 
-    donations_below_large_by_category.to_csv('data/donations_below_large_by_category.csv', index=False)
-    spending_below_large_by_category.to_csv('data/spending_below_large_by_category.csv', index=False)
+@profiling.profiled
+def aggregate_txs(df, ds, grain = GRAIN):
+    """Aggregate categorized donations and spending into the pipeline outputs,
+    per transaction timestamp when grain is None"""
+    donations_total_by_category = compact(df, ['Date', 'Category'], grain)
+    spending_total_by_category = compact(ds, ['Date', 'Category'], grain)
+
+    donations_total = compact(df, ['Date'], grain)
+    spending_total = compact(ds, ['Date'], grain)
+
+    # above 100k UAH
+    amount = LARGE_AMOUNT * 100
+    large_donations_by_category = compact(df[df['Kopiykas'] >= amount], ['Date', 'Category'], grain)
+    large_spending_by_category = compact(ds[ds['Kopiykas'] >= amount], ['Date', 'Category'], grain)
+
+    # below 100k UAH
+    donations_below_large_by_category = compact(df[df.Kopiykas < amount], ['Date', 'Category'], grain)
+    spending_below_large_by_category = compact(ds[ds.Kopiykas < amount], ['Date', 'Category'], grain)
+
+    return (large_donations_by_category, large_spending_by_category, donations_below_large_by_category, spending_below_large_by_category,
+            donations_total, spending_total, donations_total_by_category, spending_total_by_category)
+
+def merge_txs(txs, new_txs):
+    """Fold partial aggregates into existing pipeline outputs"""
+    merged = []
+    for data, new_data in zip(txs, new_txs):
+        data = pd.concat([data, new_data], ignore_index=True)
+        keys = [col for col in ['Date', 'Category'] if col in data.columns]
+        if 'Category' in keys:
+            data['Category'] = data['Category'].astype(object).fillna('')
+        merged.append(rollup(data, keys))
+    return merged
+
+@profiling.profiled
+def transactions_parts(kind):
+    """The Arrow files of the categorized transactions of a kind, in the order they were written"""
+    return sorted(glob.glob(f'{TRANSACTIONS_PATH}_{kind}/*.arrow'))
+
+def save_transactions(donations, spending, fmt = None, append = False):
+    """Keep the categorized transactions for drill-down, separate from the aggregated outputs"""
+    fmt = fmt or STORAGE_FORMAT
+    if fmt == 'csv':
+        for kind, data in [('donations', donations), ('spending', spending)]:
+            path = f'{TRANSACTIONS_PATH}_{kind}.csv'
+            data.to_csv(path, index=False, mode='a' if append else 'w', header=not (append and os.path.exists(path)))
+        return
+    if fmt == 'arrow':
+        # one file per batch, appending writes the new rows only
+        for kind, data in [('donations', donations), ('spending', spending)]:
+            parts = transactions_parts(kind)
+            number = int(os.path.basename(parts[-1]).split('.')[0]) + 1 if append and parts else 0
+            path = f'{TRANSACTIONS_PATH}_{kind}/{number:06d}.arrow'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_arrow(data, path)
+            for part in ([] if append else parts):
+                if part != path:
+                    os.remove(part)
+        return
+
+    data = pd.concat([donations.assign(kind='donations'), spending.assign(kind='spending')], ignore_index=True)
+    data['Category'] = data['Category'].astype('category')
+    path = f'{TRANSACTIONS_PATH}.parquet'
+    if not (append and os.path.exists(path)):
+        replace_dir(path, lambda tmp: data.to_parquet(tmp, partition_cols=['kind'], index=False))
+        return
+    # new files are written aside and moved into their partitions one complete file at a time
+    shutil.rmtree(f'{path}.new', ignore_errors=True)
+    data.to_parquet(f'{path}.new', partition_cols=['kind'], index=False)
+    for new in glob.glob(f'{path}.new/*/*.parquet'):
+        partition = os.path.join(path, os.path.basename(os.path.dirname(new)))
+        os.makedirs(partition, exist_ok=True)
+        os.replace(new, os.path.join(partition, os.path.basename(new)))
+    shutil.rmtree(f'{path}.new')
+
+@profiling.profiled
+def read_transactions(kind, start = None, end = None, fmt = None):
+    """Categorized transactions of a kind within the optional Date range, read only for drill-down"""
+    fmt = fmt or STORAGE_FORMAT
+    if fmt in ('csv', 'arrow'):
+        if fmt == 'csv':
+            data = pd.read_csv(f'{TRANSACTIONS_PATH}_{kind}.csv', dtype={'Kopiykas': 'int64', 'Category': 'str'}, keep_default_na=False, parse_dates=['Date'])
+        else:
+            tables = [pa.ipc.open_file(pa.memory_map(part)).read_all() for part in transactions_parts(kind)]
+            data = pa.concat_tables(tables).to_pandas(split_blocks=True)
+        if start is not None:
+            data = data[data['Date'] >= pd.Timestamp(start)]
+        if end is not None:
+            data = data[data['Date'] <= pd.Timestamp(end)]
+        return data.reset_index(drop=True)
+
+    filters = [('kind', '==', kind)]
+    if start is not None:
+        filters.append(('Date', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('Date', '<=', pd.Timestamp(end)))
+    return pd.read_parquet(f'{TRANSACTIONS_PATH}.parquet', filters=filters).drop('kind', axis=1)
+
+def extract_relevant_txs(df, start_date, end_date, save = True, grain = GRAIN):
+    """Categorize and aggregate the export"""
+    donations, spending = categorize_txs(df)
+    txs = aggregate_txs(donations, spending, grain)
+    if save:
+        publish_txs(txs)
+        save_transactions(donations, spending)
+
+    return txs
+
+def drop_seen_spending(df, seen):
+    """Export rows without the spending rows whose hash is in seen, and seen with the hashes of
+    the remaining spending rows added"""
+    spending = df[df['From Account'].notna()].drop(['To Account'], axis=1)
+    hashes = pd.util.hash_pandas_object(spending, index=False).to_numpy()
+    repeated = np.isin(hashes, seen)
+    return df.drop(spending.index[repeated]), np.union1d(seen, hashes)
+
+def save_spending_hashes(hashes, path = SPENDING_HASHES_PATH):
+    def write(tmp):
+        with open(tmp, 'wb') as f:
+            np.save(f, hashes)
+    replace_file(path, write)
+
+def read_spending_hashes(path = SPENDING_HASHES_PATH):
+    return np.load(path)
+
+def stream_txs(path = EXPORT_PATH, chunksize = CHUNKSIZE, save = True, grain = GRAIN, state_path = STATE_PATH):
+    """Streaming ETL: categorize the export chunk by chunk and fold the partial aggregates
+    into running outputs, so only one chunk of raw rows is in memory at a time. Saving
+    publishes under publish_lock and writes the state of a run over the export.
+    Returns the outputs and the rows/sec and peak RSS of the run"""
+    start = time.perf_counter()
+    rows = 0
+    txs = None
+    pending = []
+    seen_spending = np.array([], dtype='uint64')
+    last_date = None
+    with profiling.peak_rss() as peak, publish_lock() if save else contextlib.nullcontext():
+        if save:
+            mark_publishing(read_state(state_path), state_path)
+        for number, chunk in enumerate(read_data_chunks(path, chunksize)):
+            rows += len(chunk)
+            last_date = chunk['Date'].max() if last_date is None else max(last_date, chunk['Date'].max())
+
+            # spending duplicates are dropped across chunks as well
+            chunk, seen_spending = drop_seen_spending(chunk, seen_spending)
+
+            donations, spending = categorize_txs(chunk)
+            pending.append(aggregate_txs(donations, spending, grain))
+            if save:
+                save_transactions(donations, spending, append=number > 0)
+            # fold once the pending partials outgrow the running outputs, keeps the regrouping linear overall
+            if txs is None or sum(len(partial[4]) for partial in pending) >= len(txs[4]):
+                folded = [pd.concat(parts, ignore_index=True) for parts in zip(*pending)]
+                txs = folded if txs is None else merge_txs(txs, folded)
+                pending = []
+
+        if pending:
+            txs = merge_txs(txs, [pd.concat(parts, ignore_index=True) for parts in zip(*pending)])
+        txs = tuple(txs)
+        if save:
+            publish_txs(txs)
+            save_spending_hashes(seen_spending)
+            write_sources_state([path], last_date, rows, state_path)
+
+    seconds = time.perf_counter() - start
+    stats = {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds else 0,
+        'peak_rss_mb': peak.mb,
+    }
+    return txs, stats
+
+def count_txs(totals):
+    """Transactions behind the totals, one per row when the outputs weren't bucketed to a grain"""
+    return int(totals['Count'].sum()) if 'Count' in totals.columns else len(totals)
+
+def window_kpis(totals, days, value = 'UAH'):
+    """Total and count of the daily totals over the days ending on their latest Date"""
+    if len(totals) == 0:
+        return {'total': 0.0, 'count': 0}
+    dates = totals['Date']
+    start = dates.iloc[-1].floor('D') - pd.Timedelta(days=days - 1)
+    window = totals.iloc[dates.searchsorted(start, side='left'):]
+    return {'total': float(window[value].sum()), 'count': count_txs(window)}
+
+def kind_kpis(totals, value = 'UAH'):
+    kpis = {'total': float(totals[value].sum()), 'count': count_txs(totals),
+            'latest_date': str(totals['Date'].iloc[-1].date()) if len(totals) else None}
+    for name, days in KPI_WINDOWS.items():
+        kpis[name] = window_kpis(totals, days, value)
+    return kpis
+
+def days_since_launch(today = None):
+    """Days from LAUNCH_DATE to today, computed when shown rather than kept in the snapshot"""
+    return (pd.Timestamp(today or pd.Timestamp.now()).floor('D') - pd.Timestamp(LAUNCH_DATE)).days
+
+def build_kpis(txs, value = 'UAH'):
+    """KPI snapshot of the outputs: grand totals, latest day and trailing window totals and
+    counts of the donations and spending"""
+    txs = dict(zip(OUTPUTS, txs))
+    return {
+        'value': value,
+        'donations': kind_kpis(txs['donations_total'], value),
+        'spending': kind_kpis(txs['spending_total'], value),
+    }
+
+def update_kpis(kpis, new_txs, txs):
+    """KPI snapshot with the aggregates of new transactions added to the grand totals, the
+    windows are re-read from the tail of the merged outputs"""
+    new_txs, txs = dict(zip(OUTPUTS, new_txs)), dict(zip(OUTPUTS, txs))
+    updated = {'value': kpis['value']}
+    for kind in ['donations', 'spending']:
+        new_totals, totals = new_txs[f'{kind}_total'], txs[f'{kind}_total']
+        updated[kind] = {
+            'total': kpis[kind]['total'] + float(new_totals['UAH'].sum()),
+            'count': kpis[kind]['count'] + count_txs(new_totals),
+            'latest_date': str(totals['Date'].iloc[-1].date()) if len(totals) else None,
+        }
+        for name, days in KPI_WINDOWS.items():
+            updated[kind][name] = window_kpis(totals, days)
+    return updated
+
+def save_kpis(kpis, path = KPI_PATH):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(kpis, f, indent=1)
+    replace_file(path, write)
+
+def read_kpis(path = KPI_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+def read_state(state_path = STATE_PATH):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        return json.load(f)
+
+def write_state(export, last_date, rows, state_path = STATE_PATH, fmt = None):
+    """High-water mark of the processed export: byte offset after the last row, the latest Date,
+    a checksum of everything up to the offset and the storage format of the outputs"""
+    offset = len(export)
+    state = {
+        'format': fmt or STORAGE_FORMAT,
+        'offset': offset,
+        'rows': rows,
+        'last_date': str(last_date),
+        'checksum': hashlib.sha256(export[:offset]).hexdigest(),
+        'fingerprint': hashlib.sha256(export).hexdigest(),
+    }
+    return save_state(state, state_path)
+
+def write_sources_state(paths, last_date, rows, state_path = STATE_PATH, fmt = None):
+    """State of a run over several exports: the fingerprint of every export read. It has no
+    offset, update_txs rebuilds from a single export in full after it"""
+    state = {
+        'format': fmt or STORAGE_FORMAT,
+        'sources': {os.path.normpath(path): source_fingerprint(path) for path in paths},
+        'rows': rows,
+        'last_date': str(last_date),
+    }
+    return save_state(state, state_path)
+
+def save_state(state, state_path = STATE_PATH):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+    replace_file(state_path, write)
+    return state
+
+def mark_publishing(state, state_path = STATE_PATH):
+    """Flag the outputs as being rewritten. They are replaced one file at a time, a run interrupted
+    before its new state is written leaves the flag set and the next run rebuilds them in full
+    instead of merging the same tail again"""
+    if state is not None:
+        save_state({**state, 'publishing': True}, state_path)
+
+def outputs_exist(fmt = None):
+    """True when every file a state describes is there: the outputs, the cube, the KPI snapshot,
+    the transactions and the spending hashes"""
+    fmt = fmt or STORAGE_FORMAT
+    paths = [path for name in OUTPUTS + ['rollup_cube', 'kpis'] for path in dataset_files(name, fmt)]
+    if fmt == 'parquet':
+        paths.append(f'{TRANSACTIONS_PATH}.parquet')
+    elif fmt == 'csv':
+        paths.extend(f'{TRANSACTIONS_PATH}_{kind}.csv' for kind in ['donations', 'spending'])
+    paths.append(SPENDING_HASHES_PATH)
+    return (all(os.path.exists(path) for path in paths)
+            and (fmt != 'arrow' or all(transactions_parts(kind) for kind in ['donations', 'spending'])))
+
+def extended_last_row(export, offset):
+    """True when the row processed last had no line end and the export now continues it"""
+    return offset > 0 and export[offset - 1:offset] not in (b'\n', b'\r') and export[offset:offset + 1] not in (b'', b'\n', b'\r')
+
+@profiling.profiled
+def update_txs(path = EXPORT_PATH, state_path = STATE_PATH):
+    """Incremental ETL: categorize only the rows appended to the export since the last run
+    and merge their aggregates into the persisted outputs. Falls back to a full rebuild
+    when there is no state, the state is for another storage format or several exports or its
+    outputs are missing, the already processed part of the export was rewritten or a previous
+    run was interrupted while publishing. New spending rows repeating an already processed one
+    are dropped. Runs under publish_lock, so concurrent runs do not merge the same rows twice"""
+    with publish_lock():
+        state = read_state(state_path)
+        with open(path, 'rb') as f:
+            export = f.read()
+
+        if (state is None or state.get('publishing') or state.get('format') != STORAGE_FORMAT or not outputs_exist()
+                or 'sources' in state or len(export) < state['offset']
+                or hashlib.sha256(export[:state['offset']]).hexdigest() != state['checksum']
+                or extended_last_row(export, state['offset'])):
+            mark_publishing(state, state_path)
+            df = read_data(path=io.BytesIO(export))
+            txs = extract_relevant_txs(df, None, None)
+            save_spending_hashes(drop_seen_spending(df, np.array([], dtype='uint64'))[1])
+            write_state(export, df['Date'].max(), len(df), state_path)
+            return txs
+
+        tail = export[state['offset']:]
+        if not tail.strip():
+            if tail:
+                write_state(export, state['last_date'], state['rows'], state_path)
+            return read_txs()
+
+        header = export[:export.index(b'\n') + 1]
+        new_rows = read_data(path=io.BytesIO(header + tail))
+        rows = len(new_rows)
+        new_rows, seen_spending = drop_seen_spending(new_rows, read_spending_hashes())
+        donations, spending = categorize_txs(new_rows)
+        new_txs = aggregate_txs(donations, spending)
+        txs = tuple(merge_txs(read_txs(), new_txs))
+        mark_publishing(state, state_path)
+        save_transactions(donations, spending, append=True)
+        publish_txs(txs, kpis=update_kpis(read_kpis(), new_txs, txs))
+        save_spending_hashes(seen_spending)
+        write_state(export, max(pd.Timestamp(state['last_date']), new_rows['Date'].max()),
+                    state['rows'] + rows, state_path)
+        return txs
+
+def frame_fingerprint(data):
+    """Content hash of a frame or series"""
+    digest = hashlib.sha1(pd.util.hash_pandas_object(data).to_numpy().tobytes())
+    if isinstance(data, pd.DataFrame):
+        digest.update(repr(list(data.columns)).encode())
+    return digest.hexdigest()
+
+def normalize_donors(donations):
+    """Date, Donor, Kopiykas of the donations with the excluded rows dropped and the donor
+    aliases resolved in one regex pass, cached per input fingerprint"""
+    fingerprint = frame_fingerprint(donations)
+    if fingerprint in _donor_cache:
+        return _donor_cache[fingerprint]
+
+    excluded = '|'.join(re.escape(text) for text in category_rules.DONOR_EXCLUSIONS)
+    text_columns = [col for col in donations.columns if not pd.api.types.is_numeric_dtype(donations[col])
+                    and not pd.api.types.is_datetime64_any_dtype(donations[col])]
+    # remove numbers from the Commentary
+    commentary = donations['Commentary'].str.replace(r'\d+', '', regex=True)
+    mask = commentary.str.contains(excluded, na=False).to_numpy()
+    for col in text_columns:
+        if col != 'Commentary':
+            mask = mask | donations[col].astype(str).str.contains(excluded, na=False).to_numpy()
+
+    # each alternative scans the whole commentary before the next one is tried, so the first alias wins
+    patterns, names = zip(*category_rules.DONOR_ALIASES)
+    aliases = commentary.str.extract('^(?:' + '|'.join(f'.*?({re.escape(pattern)})' for pattern in patterns) + ')')
+    matched = aliases.notna().to_numpy()
+    donor = np.where(matched.any(axis=1), np.array(names, dtype=object)[matched.argmax(axis=1)], commentary.to_numpy(dtype=object))
+
+    donors = pd.DataFrame({'Donor': donor, 'Kopiykas': donations['Kopiykas'].to_numpy()}, index=donations.index)
+    if 'Date' in donations.columns:
+        donors.insert(0, 'Date', donations['Date'])
+    donors = donors[~mask]
+
+    if len(_donor_cache) >= 8:
+        _donor_cache.pop(next(iter(_donor_cache)))
+    _donor_cache[fingerprint] = donors
+    return donors
+
+@profiling.profiled
+def top_donors(donations, n = None, amount = 0, start = None, end = None):
+    """Donors by total UAH over the optional Date window, at least amount each, largest n first"""
+    donors = normalize_donors(donations)
+    if start is not None:
+        donors = donors[donors['Date'] >= pd.Timestamp(start)]
+    if end is not None:
+        donors = donors[donors['Date'] <= pd.Timestamp(end)]
+
+    totals = (donors.groupby('Donor')['Kopiykas'].sum() / 100).rename('UAH')
+    totals = totals[totals >= amount].sort_values(ascending=False)
+    return totals.head(n) if n else totals
 
 def extract_top_donors(large_donations, amount):
     """Top donors by amount"""
-    # remove numbers from the Commentary
-    large_donations['Commentary'] = large_donations['Commentary'].str.replace(r'\d+', '', regex=True)
-    large_donations = large_donations[~large_donations.apply(lambda row: row.astype(str).str.contains('продажу валюти').any(), axis=1)]
-    large_donations = large_donations[~large_donations.apply(lambda row: row.astype(str).str.contains('Луценко Ігор Вікторович').any(), axis=1)]
-    # extract donor names from the Commentary
-    mask = large_donations['Commentary'].str.contains('РУШ', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'eva.ua'
-    mask = large_donations['Commentary'].str.contains('КОНСАЛТИНГОВА ГРУПА', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'КОНСАЛТИНГОВА ГРУПА \"A-95\"'
-    mask = large_donations['Commentary'].str.contains('UNITED HELP UKRAINE', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'UNITED HELP UKRAINE'
-    mask = large_donations['Commentary'].str.contains('АМІК УКРАЇНА', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'АМІК УКРАЇНА'
-    mask = large_donations['Commentary'].str.contains('Торгович Оксана Станіславівна', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'Приват Банк'
-    mask = large_donations['Commentary'].str.contains('РО \"УКУ УГКЦ\"', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'РО \"УКУ УГКЦ\"'
-    mask = large_donations['Commentary'].str.contains('ФОНД \"ДЯКУЮ ТОБІ\"', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'БФ \"ДЯКУЮ ТОБІ\"'
-    mask = large_donations['Commentary'].str.contains('ТОВ "ФК \"ЕВО\"', na=False)
-    large_donations.loc[mask, 'Commentary'] = 'ТОВ "ФК \"ЕВО\"'
-
-    # sum donations by donor
-    top_donors = pd.DataFrame(large_donations.groupby('Commentary')['UAH'].sum())
-    # filter over 1M UAH donors
-    top_donors = top_donors[top_donors['UAH'] >= amount]
-    top_donors = top_donors.sort_values('UAH', ascending = False)
-    top_donors = pd.DataFrame(top_donors['UAH'].apply(format_money))
-    top_donors = top_donors.reset_index().rename(columns={'Commentary': 'Top Donors'})
-
-    return top_donors
+    top = pd.DataFrame(top_donors(large_donations, amount=amount).apply(format_money))
+    return top.rename_axis('Top Donors').reset_index()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Categorize and aggregate bank exports into the dashboard outputs')
+    parser.add_argument('exports', nargs='+', help='export files or glob patterns')
+    parser.add_argument('--workers', type=int, default=None, help='parser processes, all cores by default')
+    parser.add_argument('--no-save', action='store_true', help='run the stages without writing the outputs')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream a single export this many rows at a time instead of reading it whole')
+    args = parser.parse_args()
+
+    paths = sorted({path for pattern in args.exports for path in glob.glob(pattern)})
+    if not paths:
+        parser.error(f'no export matches {args.exports}')
+    if args.chunksize and len(paths) > 1:
+        parser.error('--chunksize streams a single export')
+
+    start = time.perf_counter()
+    if args.chunksize:
+        txs, stats = stream_txs(paths[0], args.chunksize, save=not args.no_save)
+        timings = {'stream': stats['seconds']}
+        peak = 'unavailable' if stats['peak_rss_mb'] is None else f"{stats['peak_rss_mb']:.1f} MB"
+        print(f"{stats['rows']} rows streamed, {stats['rows_per_sec']:,.0f} rows/s, peak RSS {peak}")
+    else:
+        txs, timings = run_etl(paths, args.workers, save=not args.no_save)
+    print(f'{len(paths)} exports, {len(txs[OUTPUTS.index("donations_total")])} donation days')
+    for stage, seconds in timings.items():
+        print(f'  {stage:<16}{seconds:8.2f} s')
+    print(f'  {"total":<16}{time.perf_counter() - start:8.2f} s')
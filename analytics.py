@@ -0,0 +1,138 @@
+"""Time-based trends over the daily donations and spending series
+
+The outputs are resampled to one row per calendar day, days without transactions count as 0,
+so a window of 30 days is 30 calendar days whatever the number of transactions in it. A window
+reaching back before the first day covers fewer days, its mean is over the days it covers. The
+windowed sums slide over the series in one pass. Results are cached per version of the datasets
+they are computed from and of the FX table.
+"""
+import functools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import ETL as etl
+import currency
+import profiling
+
+# trailing windows in calendar days
+WINDOWS = [7, 30, 90]
+CACHE_MAX_ENTRIES = 32
+
+cache = OrderedDict()
+cache_stats = {'hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+def daily_series(data, value = 'UAH'):
+    """value summed by calendar day from the first to the last day, a Series over the Date column
+    or a DatetimeIndex"""
+    dates = data.index if isinstance(data, pd.Series) else data['Date']
+    amounts = data if isinstance(data, pd.Series) else data[value]
+    if isinstance(dates, pd.PeriodIndex):
+        dates = dates.to_timestamp()
+    sums = amounts.groupby(pd.DatetimeIndex(dates).floor('D')).sum()
+    if len(sums) == 0:
+        return sums
+    days = pd.date_range(sums.index[0], sums.index[-1], freq='D', name='Date')
+    return sums.reindex(days, fill_value=0)
+
+def rolling(series, days, how = 'sum'):
+    """Trailing sum or mean over days calendar days of a series indexed by date, the mean of
+    a window starting before the series is over the days it covers"""
+    daily = series if getattr(series.index, 'freqstr', None) == 'D' else daily_series(series)
+    window = daily.rolling(f'{days}D')
+    # one row per calendar day, so the mean of a window is its sum over its days
+    return window.sum() if how == 'sum' else window.mean()
+
+def rolling_frame(daily, windows = WINDOWS):
+    """The daily columns with their trailing sum and daily mean over every window"""
+    # calendar days in every window, fewer than days until the window is full
+    covered = {days: pd.Series(1.0, index=daily.index).rolling(f'{days}D').sum() for days in windows}
+    columns = {}
+    for col in daily.columns:
+        columns[col] = daily[col]
+        for days in windows:
+            sums = daily[col].rolling(f'{days}D').sum()
+            columns[f'{col} {days}d'] = sums
+            columns[f'{col} {days}d mean'] = sums / covered[days]
+    return pd.DataFrame(columns)
+
+def versioned(*names):
+    """Cache func(value, ...) per version of the named datasets, and of the FX table outside UAH.
+    The results are shared between sessions and must not be modified"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(value = 'UAH', *args, **kwargs):
+            key = (func.__name__, value, args, tuple(sorted(kwargs.items())), tuple(etl.dataset_stamp(name) for name in names),
+                   currency.rates_stamp() if value != 'UAH' else None)
+            with _lock:
+                if key in cache:
+                    cache.move_to_end(key)
+                    cache_stats['hits'] += 1
+                    return cache[key]
+                cache_stats['misses'] += 1
+            result = func(value, *args, **kwargs)
+            with _lock:
+                cache[key] = result
+                while len(cache) > CACHE_MAX_ENTRIES:
+                    cache.popitem(last=False)
+            return result
+        return wrapper
+    return decorate
+
+@versioned('donations_total', 'spending_total')
+@profiling.profiled
+def daily_totals(value = 'UAH'):
+    """Donations and Spending by calendar day over the whole history"""
+    donations = daily_series(currency.converted('donations_total', value), value)
+    spending = daily_series(currency.converted('spending_total', value), value)
+    daily = pd.concat({'Donations': donations, 'Spending': spending}, axis=1).fillna(0)
+    return daily.asfreq('D', fill_value=0)
+
+@versioned('donations_total', 'spending_total')
+@profiling.profiled
+def trends(value = 'UAH'):
+    """Daily Donations and Spending with their 7, 30 and 90 day sums and means"""
+    return rolling_frame(daily_totals(value))
+
+@versioned('donations_total', 'spending_total')
+@profiling.profiled
+def burn_rate(value = 'UAH', days = 30):
+    """Spending over the trailing days against the donations over the same days: the net inflow
+    and the burn rate, spending per unit donated, NaN without donations in the window"""
+    daily = daily_totals(value)
+    donations = daily['Donations'].rolling(f'{days}D').sum()
+    spending = daily['Spending'].rolling(f'{days}D').sum()
+    return pd.DataFrame({'Donations': donations, 'Spending': spending, 'Net': donations - spending,
+                         'Burn rate': spending / donations.where(donations > 0)})
+
+@versioned('donations_total_by_category', 'spending_total_by_category')
+@profiling.profiled
+def runway(value = 'UAH', days = 30):
+    """Per category: donations and spending since launch, the balance, the mean daily spending
+    over the trailing days ending on the latest day and the days the balance lasts at that rate.
+    With a shorter history the mean is over the days since the first transaction.
+    Runway is inf without recent spending and 0 once the balance is spent, the table is empty without transactions"""
+    donations = currency.converted('donations_total_by_category', value)
+    spending = currency.converted('spending_total_by_category', value)
+    # from the dates of both, min/max of an empty frame is NaT and would hide the other's
+    dates = pd.concat([donations['Date'], spending['Date']])
+    if dates.empty:
+        return pd.DataFrame(columns=['Donations', 'Spending', 'Balance', 'Daily burn', 'Runway days'], dtype='float64').rename_axis('Category')
+    first = dates.min().floor('D')
+    latest = dates.max().floor('D')
+    recent = spending[spending['Date'] >= latest - pd.Timedelta(days=days - 1)]
+    covered = min(days, (latest - first).days + 1)
+
+    table = pd.DataFrame({
+        'Donations': donations.groupby('Category')[value].sum(),
+        'Spending': spending.groupby('Category')[value].sum(),
+    }).fillna(0)
+    table['Balance'] = table['Donations'] - table['Spending']
+    table['Daily burn'] = recent.groupby('Category')[value].sum().reindex(table.index, fill_value=0) / covered
+    with np.errstate(divide='ignore', invalid='ignore'):
+        runway_days = np.where(table['Balance'] > 0, table['Balance'] / table['Daily burn'], 0.0)
+    table['Runway days'] = runway_days
+    return table.sort_values('Balance', ascending=False)
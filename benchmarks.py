@@ -0,0 +1,537 @@
+"""Benchmarks for the ETL, aggregation and charting code
+
+    python benchmarks.py --rows 10000 100000 1000000
+    python benchmarks.py --rows 100000 --save-baseline
+    python benchmarks.py --micro
+
+Each stage runs on a synthetic export (synthetic_export.py). Wall time is the best of
+--repeat runs, memory is the tracemalloc peak of one extra run. The results are compared
+against the stored baseline and the run fails when a stage got slower than --tolerance.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+import ETL as etl
+import analytics
+import charting_tools
+import currency
+import data_aggregation_tools as da
+import profiling
+import synthetic_export
+
+BASELINE_PATH = 'benchmarks_baseline.json'
+
+def timed(func, *args, repeat = 3, setup = None, **kwargs):
+    """Best wall time of repeat runs in seconds, setup is called untimed before every run"""
+    best = float('inf')
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def peak_memory(func, *args, setup = None, **kwargs):
+    """Peak traced allocation of one run in MB"""
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+def random_txs(rows, categories, seed = 0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Date': pd.Timestamp('2023-02-15') + pd.to_timedelta(rng.integers(0, 365 * 86400, rows), unit='s'),
+        'Category': rng.choice([f'category {i}' for i in range(categories)], rows),
+        'UAH': rng.lognormal(6, 2, rows),
+    })
+
+def pipeline_stages(path):
+    """(name, callable) of every stage, the inputs of a stage are prepared by the ones before it"""
+    raw = etl.read_data(path=path)
+    donations, spending = etl.categorize_txs(raw)
+    txs = dict(zip(etl.OUTPUTS, etl.aggregate_txs(donations, spending)))
+    large_donations = raw[raw['To Account'].notna() & (raw['Kopiykas'] >= etl.LARGE_AMOUNT * 100)].drop(['From Account'], axis=1)
+
+    by_category = txs['donations_total_by_category']
+    categories = by_category.groupby('Category')['UAH'].sum().sort_values(ascending=False).index.tolist()
+    monthly = pd.merge(da.sum_by_period(txs['donations_total'], 'M'), da.sum_by_period(txs['spending_total'], 'M'),
+                       left_index=True, right_index=True, how='left')
+    monthly.columns = ['Donations', 'Spending']
+    monthly.index = monthly.index.to_timestamp()
+    by_cat = pd.DataFrame(by_category.groupby('Category')['UAH'].sum())
+
+    def pies():
+        fig1 = charting_tools.pie_plot(by_cat, 'UAH', 'Donations by category', False)
+        fig2 = charting_tools.pie_plot(by_cat, 'UAH', 'Spending by category', False)
+        return charting_tools.subplot_horizontal(fig1, fig2, 1, 2, 'domain', 'domain', '', '', False)
+
+    return [
+        ('read_data', lambda: etl.read_data(path=path)),
+        ('categorize_txs', lambda: etl.categorize_txs(raw)),
+        ('aggregate_txs', lambda: etl.aggregate_txs(donations, spending)),
+        ('extract_top_donors', lambda: etl.extract_top_donors(large_donations.copy(), 1000000)),
+        ('sum_by_period_by_category', lambda: da.sum_by_period_by_category(categories, 'D', by_category, 'Category')),
+        ('chart_by_period', lambda: charting_tools.chart_by_period(by_category, categories, 'D', '')),
+        ('bar_plot_grouped', lambda: charting_tools.bar_plot_grouped(monthly, 'Donations', 'Spending', '', False)),
+        ('pie_plot', pies),
+    ]
+
+def clear_caches():
+    """Forget the memoized figures and donor tables, so every run builds them"""
+    charting_tools.clear_figure_cache()
+    etl._donor_cache.clear()
+
+def run_pipeline_benchmarks(rows, repeat = 3, seed = 0):
+    """Seconds and peak MB of every stage on a synthetic export of rows transactions,
+    the caches are cleared before every run"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = synthetic_export.write_export(os.path.join(tmp, 'export.csv'), rows, seed)
+        results = {}
+        for name, stage in pipeline_stages(path):
+            results[name] = {'seconds': timed(stage, repeat=repeat, setup=clear_caches),
+                             'peak_mb': peak_memory(stage, setup=clear_caches)}
+    return results
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Print every stage against its baseline, returns the stages that got slower than tolerance"""
+    regressions = []
+    for rows, stages in results.items():
+        print(f'{rows} rows')
+        for name, result in stages.items():
+            line = f"  {name:<28}{result['seconds'] * 1000:10.1f} ms {result['peak_mb']:8.1f} MB"
+            reference = baseline.get(rows, {}).get(name)
+            if reference:
+                ratio = result['seconds'] / reference['seconds']
+                line += f'  {ratio:5.2f}x baseline'
+                if ratio > 1 + tolerance:
+                    line += '  REGRESSION'
+                    regressions.append((rows, name))
+            print(line)
+    return regressions
+
+def merge_chain_sum_by_period_by_category(categories, period, data, category, value = 'UAH'):
+    """Previous implementation: a filter + groupby per category and a chain of outer merges"""
+    data_frames = [da.sum_category_by_date(category_name, period, data, category, value) for category_name in categories]
+    return reduce(lambda left, right: pd.merge(left, right, on='Date', how='outer'), data_frames)
+
+def bench_sum_by_period_by_category(rows = 100000, category_counts = (5, 20, 50, 100), period = 'D'):
+    print(f'sum_by_period_by_category, {rows} rows, period {period}')
+    for count in category_counts:
+        data = random_txs(rows, count)
+        categories = sorted(data['Category'].unique())
+        before = timed(merge_chain_sum_by_period_by_category, categories, period, data, 'Category')
+        after = timed(da.sum_by_period_by_category, categories, period, data, 'Category')
+        print(f'  {count:>4} categories: merge chain {before * 1000:8.1f} ms, groupby {after * 1000:8.1f} ms, {before / after:5.1f}x')
+
+def scalar_format_money(value):
+    """Previous implementation: a Python call per label"""
+    if abs(value) >= 1e6:
+        return '{:.2f}M'.format(value / 1e6)
+    elif abs(value) >= 1e3:
+        return '{:.2f}K'.format(value / 1e3)
+    else:
+        return '{:.2f}'.format(value)
+
+def bench_format_money(sizes = (1000, 10000, 100000)):
+    """Chart scale: a daily stacked chart over a year and a hundred categories is ~36500 labels"""
+    print('format_money')
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        values = pd.Series(rng.lognormal(6, 3, size))
+        before = timed(values.apply, scalar_format_money)
+        after = timed(etl.format_money_vec, values)
+        print(f'  {size:>7} values: apply {before * 1000:8.1f} ms, vectorized {after * 1000:8.1f} ms, {before / after:5.1f}x')
+
+def wide_stack_bar_plot(categories, period, data):
+    """Previous implementation: a wide period x category matrix and a go.Bar per column added in a loop"""
+    df = da.sum_by_period_by_category(categories, period, data, 'Category').fillna(0)
+    df['Date'] = df['Date'].astype(str)
+    fig = charting_tools.go.Figure()
+    for column in df.columns[1:]:
+        fig.add_trace(charting_tools.go.Bar(name=column, x=df['Date'], y=df[column], text=df[column].apply(scalar_format_money)))
+    return fig
+
+def bench_stack_bar_plot(grid = ((5, 100), (20, 365), (50, 1000), (100, 1000))):
+    print('stacked chart, categories x periods')
+    rng = np.random.default_rng(0)
+    for count, periods in grid:
+        dates = pd.Timestamp('2023-02-15') + pd.to_timedelta(np.repeat(np.arange(periods), count), unit='D')
+        data = pd.DataFrame({'Date': dates, 'Category': np.tile([f'category {i}' for i in range(count)], periods),
+                             'UAH': rng.lognormal(6, 2, count * periods)})
+        categories = [f'category {i}' for i in range(count)]
+        before = timed(wide_stack_bar_plot, categories, 'D', data, repeat=1)
+        after = timed(lambda: charting_tools.stack_bar_plot(da.sum_by_period_long(categories, 'D', data, 'Category'), '', False), repeat=1)
+        print(f'  {count:>4} x {periods:<5}: wide loop {before * 1000:8.1f} ms, long batch {after * 1000:8.1f} ms, {before / after:5.1f}x')
+
+def eager_read_txs(fmt = None):
+    """Previous implementation: all eight outputs and the cube read at startup"""
+    fmt = fmt or etl.STORAGE_FORMAT
+    if fmt != 'parquet':
+        return [etl.load_dataset(name, fmt) for name in etl.OUTPUTS] + [etl.read_cube(fmt)]
+    data = etl.read_dataset()
+    txs = {}
+    for name, (kind, size) in etl.PARTITIONS.items():
+        txs[name] = data[(data['kind'] == kind) & (data['size'] == size)].drop(['kind', 'size'], axis=1).sort_values('Date').reset_index(drop=True)
+    for kind in ['donations', 'spending']:
+        txs[f'{kind}_total'] = etl.rollup(txs[f'{kind}_total_by_category'].drop('Category', axis=1), ['Date'])
+    return [txs[name] for name in etl.OUTPUTS] + [etl.read_cube(fmt)]
+
+def pipeline_startup(path):
+    """Previous app startup: the whole ETL run in memory from the export"""
+    txs = etl.extract_relevant_txs(etl.read_data(path=path), None, None, save=False)
+    return list(txs) + [etl.build_cube(txs)]
+
+def lazy_startup(fmt = None):
+    """What the dashboard reads before its first render: the cube and the two totals"""
+    etl.datasets.clear()
+    return [etl.get_dataset(name, fmt) for name in ['rollup_cube', 'donations_total', 'spending_total']]
+
+def frames_mb(frames):
+    return sum(frame.memory_usage(deep=True).sum() if isinstance(frame, pd.DataFrame) else frame.memory_usage(deep=True)
+               for frame in frames) / 2**20
+
+def bench_cold_start(rows = 200000, formats = ('parquet', 'arrow')):
+    """Startup from the export against reading the published outputs, eagerly or lazily, in every format"""
+    print(f'dashboard cold start, {rows} rows export')
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'data'))
+        path = synthetic_export.write_export(os.path.join(tmp, 'data', 'export.csv'), rows)
+        os.chdir(tmp)
+        try:
+            txs = etl.extract_relevant_txs(etl.read_data(path=path), None, None, save=False)
+            for fmt in formats:
+                etl.save_txs(txs, fmt)
+                etl.save_cube(etl.build_cube(txs), fmt)
+            loads = [('pipeline from the export', lambda: pipeline_startup(path))]
+            for fmt in formats:
+                loads += [(f'eager read, {fmt}', lambda fmt=fmt: eager_read_txs(fmt)),
+                          (f'lazy registry, {fmt}', lambda fmt=fmt: lazy_startup(fmt))]
+            for name, load in loads:
+                seconds = timed(load, repeat=1)
+                peak = peak_memory(load)
+                print(f'  {name:<26}{seconds * 1000:8.1f} ms, peak {peak:7.1f} MB, held {frames_mb(load()):6.1f} MB')
+        finally:
+            os.chdir(cwd)
+
+def process_memory():
+    """Proportional and private resident MB of this process, shared pages count once per sharer in pss"""
+    with open('/proc/self/smaps_rollup') as f:
+        fields = dict(line.split(':') for line in f.read().splitlines()[1:])
+    kb = lambda name: int(fields[name].split()[0])
+    return kb('Pss') / 1024, (kb('Private_Clean') + kb('Private_Dirty')) / 1024
+
+def session(workdir, fmt, ready, results):
+    """A simulated viewer: open every dataset and the transactions, read their numeric columns and hold them"""
+    os.chdir(workdir)
+    # read the smallest dataset once and drop it, so the lazily imported reader code isn't counted as data
+    etl.load_dataset('spending_total', fmt)
+    before = process_memory()
+    frames = [etl.get_dataset(name, fmt) for name in etl.OUTPUTS + ['rollup_cube']]
+    frames += [etl.read_transactions(kind, fmt=fmt) for kind in ['donations', 'spending']]
+    for frame in frames:
+        frame.select_dtypes('number').sum() if isinstance(frame, pd.DataFrame) else frame.sum()
+    ready.wait()
+    after = process_memory()
+    results.put((after[0] - before[0], after[1] - before[1]))
+    ready.wait()
+
+def bench_shared_sessions(rows = 1000000, sessions = (1, 2, 4, 8), formats = ('parquet', 'arrow')):
+    """Load test: N processes hold the datasets at once, the total proportional memory of a shared
+    memory-mapped store grows only by the fixed private overhead of each reader while decoded copies
+    grow with the data times N"""
+    print(f'concurrent sessions, {rows} rows export, dataset memory summed over the processes')
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'data'))
+        path = synthetic_export.write_export(os.path.join(tmp, 'data', 'export.csv'), rows)
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            donations, spending = etl.categorize_txs(etl.read_data(path=path))
+            txs = etl.aggregate_txs(donations, spending)
+            for fmt in formats:
+                etl.save_txs(txs, fmt)
+                etl.save_cube(etl.build_cube(txs), fmt)
+                etl.save_transactions(donations, spending, fmt)
+        finally:
+            os.chdir(cwd)
+
+        for fmt in formats:
+            for count in sessions:
+                ready, results = context.Barrier(count + 1), context.Queue()
+                workers = [context.Process(target=session, args=(tmp, fmt, ready, results)) for _ in range(count)]
+                for worker in workers:
+                    worker.start()
+                ready.wait()
+                ready.wait()
+                measured = [results.get() for _ in workers]
+                for worker in workers:
+                    worker.join()
+                pss = sum(m[0] for m in measured)
+                private = sum(m[1] for m in measured) / count
+                print(f'  {fmt:<8}{count:>3} sessions: total pss {pss:8.1f} MB, private {private:7.1f} MB per session')
+
+def untyped_read_data(path, text_dtype):
+    """Previous representation: text columns as text_dtype and the amounts as float kopiykas"""
+    dtypes = {col: text_dtype for col in etl.CATEGORICAL_COLUMNS + ['Commentary']}
+    df = pd.read_csv(path, dtype={**dtypes, 'UAH': 'float'}, index_col=None, parse_dates=['Date'])
+    df['Subcategory'] = df['Subcategory'].fillna('')
+    df['Category'] = df['Category'].fillna('')
+    df.insert(df.columns.get_loc('UAH'), 'Kopiykas', df.pop('UAH') * 100)
+    return df
+
+def bench_compact_dtypes(rows = 1000000):
+    """Memory of the loaded export and time of the categorization and groupbys per column representation"""
+    print(f'export dtypes, {rows} rows export')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = synthetic_export.write_export(os.path.join(tmp, 'export.csv'), rows)
+        for name, read in [('object strings, float', lambda: untyped_read_data(path, object)),
+                           ('str, float', lambda: untyped_read_data(path, 'str')),
+                           ('categorical, int kopiykas', lambda: etl.read_data(path=path))]:
+            read_seconds = timed(read, repeat=1)
+            raw = read()
+            donations, spending = etl.categorize_txs(raw)
+            categorize = timed(etl.categorize_txs, raw, repeat=1)
+            aggregate = timed(etl.aggregate_txs, donations, spending, repeat=1)
+            print(f'  {name:<26}{frames_mb([raw]):7.1f} MB, read {read_seconds * 1000:7.1f} ms, '
+                  f'categorize {categorize * 1000:7.1f} ms, aggregate {aggregate * 1000:7.1f} ms')
+
+def replace_category(data, column, value):
+    """Replace Category with Subcategory"""
+    df_copy = data.copy()  # Create a copy of the DataFrame to avoid modifying the original
+    df_copy.loc[df_copy[column] == value, 'Category'] = df_copy['Subcategory']
+    return df_copy
+
+def replace_category_values(data, category_column, val1, val2):
+    """Mapping of Category values"""
+    df_copy = data.copy()
+    df_copy[category_column] = df_copy[category_column].replace(val1, val2)
+    return df_copy
+
+def chained_categorize_txs(df):
+    """Previous category mapping: a pass over the whole frame per rule, kept as the reference of
+    the rule table of category_rules.py. Takes the read_data frame, its categorical columns are
+    compared as strings and a missing Commentary matches nothing"""
+    df = df.astype({'Category': 'str', 'Subcategory': 'str'})
+    df['Commentary'] = df['Commentary'].fillna('').astype(str)
+
+    # spending
+    ds = df[df['From Account'].notna()]; ds = ds.drop(['To Account'], axis=1)
+
+    # donations
+    df = df[df['To Account'].notna()]; df = df.drop(['From Account'], axis=1)
+
+    df = df[~df['Commentary'].str.contains('Переказ між рахунками організації')]
+    ds = ds[~ds['Commentary'].str.contains('Переказ між рахунками організації')]
+    df = df[~df['Commentary'].str.contains('Гривнi вiд продажу')]
+    ds = ds.drop_duplicates()
+    ds = ds[~ds['Commentary'].str.contains('продаж', case=False).fillna(False)]
+    ds = ds[~ds['Commentary'].str.contains('списання', case=False).fillna(False)]
+
+    ds = replace_category(ds, 'Category', 'Закупівлі')
+    df = replace_category(df, 'Category', 'Донати')
+    df = replace_category(df, 'Category', 'Гранти')
+    df = replace_category(df, 'Category', 'Income categories')
+
+    old_values = ['Taxes', 'ремонт Авто', 'Юридичні послуги', 'Salary']
+    ds = replace_category_values(ds, 'Category', old_values, 'Адмін')
+
+    df = df.drop(['Subcategory'], axis=1)
+    ds = ds.drop(['Subcategory'], axis=1)
+
+    df['Category'] = df['Category'].str.replace('Адмін Донати', 'Адмін')
+    df['Category'] = df['Category'].str.replace('Донати ', '')
+
+    for account, category in [('Приват 1000 дронів для України', '1000 дронів для України'),
+                              ('Вікторі Дронс', 'Victory Drones'),
+                              ('ПриватБанк Загальний рахунок зборів', 'Загальні донати'),
+                              ('Приват Загальний рахунок зборів', 'Загальні донати'),
+                              ('ПриватБанк PLN', 'Загальні донати'),
+                              ('ПриватБанк Адмін рахунок', 'Адмін')]:
+        mask = df['To Account'] == account
+        df.loc[mask, 'Category'] = category
+    mask = ds['From Account'] == 'ПриватБанк Адмін рахунок'
+    ds.loc[mask, 'Category'] = 'Адмін'
+
+    mask = df['To Account'] == 'Приват Літай'
+    df.loc[mask, 'Category'] = 'Літай'
+
+    mask = df['To Account'] == 'Приват На захисті краси України'
+    df.loc[mask, 'Category'] = 'На захисті краси України'
+
+    ds['Category'] = ds['Category'].str.replace('техніки Літай', 'Літай')
+    ds['Category'] = ds['Category'].str.replace('Закупівлі на захисті краси', 'На захисті краси України')
+    ds['Category'] = ds['Category'].str.replace('Закупівля ', '')
+    ds['Category'] = ds['Category'].str.replace('Дрони Люті пташки', 'Люті пташки')
+    ds['Category'] = ds['Category'].str.replace('Адміністративні витрати', 'Адмін')
+    df['Category'] = df['Category'].str.replace('Грант МЛПК', 'МЛПК')
+
+    for account, category in [('Приват Банк Адмін рахунок', 'Адмін'), ('Вікторі Дронс', 'Victory Drones'),
+                              ('Приват Літай', 'Літай'), ('Приват На захисті краси України', 'На захисті краси України')]:
+        mask = ds['From Account'] == account
+        ds.loc[mask, 'Category'] = category
+
+    ds = ds.drop(['From Account'], axis=1)
+    df = df.drop(['To Account'], axis=1)
+
+    condition = ds['Category'].str.contains('|'.join(['Лопати', 'Антени', 'Піротехніка', 'Планшети']), case=False)
+    ds.loc[condition, 'Category'] = 'Лопати + Антени + Піротехніка + Планшети'
+
+    ds['Category'] = ds['Category'].str.replace('Suppliers and Contractors', 'Адмін')
+
+    mask = df['Commentary'].str.contains('люті пташки', case=False, na=False)
+    df.loc[mask, 'Category'] = 'Люті пташки'
+    mask = df['Commentary'].str.contains('MOBILE LAUNDRY SHOWER UNITS', case=False, na=False)
+    df.loc[mask, 'Category'] = 'МЛПК'
+    mask = df['Commentary'].str.contains('From UK ONLINE GIVING FOUNDATION', case=False, na=False)
+    df.loc[mask, 'Category'] = 'Загальні донати'
+    mask = ds['Category'].str.contains('Канцелярія', case=False, na=False)
+    ds.loc[mask, 'Category'] = 'Адмін'
+    mask = ds['Category'].str.contains('обладнання', case=False, na=False)
+    ds.loc[mask, 'Category'] = 'Обладнання'
+    mask = ds['Category'].str.contains('Комісія банку', case=False, na=False)
+    ds.loc[mask, 'Category'] = 'Адмін'
+    mask = ds['Category'].str.contains('бухгалтерські послуги', case=False, na=False)
+    ds.loc[mask, 'Category'] = 'Адмін'
+
+    df = df.drop(['Commentary'], axis=1)
+    ds = ds.drop(['Commentary'], axis=1)
+    return df, ds
+
+def bench_categorize(rows = 400000):
+    """Category mapping: a pass over the frame per rule against the compiled rule table"""
+    print(f'category mapping, {rows} rows export')
+    raw = etl.read_data(path=io.StringIO(synthetic_export.generate_export(rows).to_csv(index=False)))
+    print(f'  chained passes {timed(chained_categorize_txs, raw) * 1000:8.1f} ms, '
+          f'rule table {timed(etl.categorize_txs, raw) * 1000:8.1f} ms')
+
+def random_rates(start = '2023-01-01', end = None, seed = 0):
+    """Daily USD and EUR rates as a random walk, UAH per unit"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, end or pd.Timestamp.now().floor('D'), freq='D')
+    walk = np.exp(np.cumsum(rng.normal(0, 0.003, (len(dates), 2)), axis=0))
+    return pd.DataFrame({'Date': dates, 'USD': 37 * walk[:, 0], 'EUR': 40 * walk[:, 1]})
+
+def row_convert(data, rates, currency):
+    """Naive conversion: a rate lookup per row"""
+    table = rates.set_index('Date')[currency]
+    return data.apply(lambda row: row['UAH'] / table.asof(row['Date'].floor('D')), axis=1)
+
+def bench_currency(rows = 1000000):
+    """Daily rate conversion of the transactions, and the cached conversion the dashboard selector reads"""
+    print(f'currency conversion, {rows} transactions')
+    rates = random_rates()
+    data = random_txs(rows, 20)
+    merged = lambda: pd.merge_asof(data.sort_values('Date'), rates.assign(Date=rates['Date'].astype(data['Date'].dtype)), on='Date')
+    sample = data.head(10000)
+    print(f'  row by row apply, 10000 rows {timed(row_convert, sample, rates, "USD", repeat=1) * 1000:8.1f} ms')
+    print(f'  pd.merge_asof              {timed(merged, repeat=1) * 1000:8.1f} ms')
+    print(f'  currency.convert USD, EUR  {timed(currency.convert, data, rates=rates, repeat=1) * 1000:8.1f} ms')
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'data'))
+        path = synthetic_export.write_export(os.path.join(tmp, 'data', 'export.csv'), min(rows, 200000))
+        os.chdir(tmp)
+        try:
+            etl.update_txs(path)
+            rates.to_csv(currency.FX_PATHS[-1], index=False)
+            for label in ['first selection', 'cached']:
+                seconds = timed(lambda: [currency.converted(name, 'USD') for name in ['rollup_cube', 'donations_total', 'spending_total']], repeat=1)
+                print(f'  dashboard {label:<17}{seconds * 1000:8.1f} ms')
+        finally:
+            os.chdir(cwd)
+
+def naive_trends(daily, windows = analytics.WINDOWS):
+    """Per day filter of the trailing rows of every window"""
+    columns = {}
+    for col in daily.columns:
+        for days in windows:
+            columns[f'{col} {days}d'] = [daily.loc[day - pd.Timedelta(days=days - 1):day, col].sum() for day in daily.index]
+    return pd.DataFrame(columns, index=daily.index)
+
+def bench_trends(rows = 200000):
+    """Rolling windows over the daily series: a filter per day against the sliding sums, cold and cached"""
+    print(f'rolling trends, {rows} rows export')
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'data'))
+        path = synthetic_export.write_export(os.path.join(tmp, 'data', 'export.csv'), rows)
+        os.chdir(tmp)
+        try:
+            etl.update_txs(path)
+            daily = analytics.daily_totals()
+            print(f'  {len(daily)} days')
+            print(f'  filter per day       {timed(naive_trends, daily, repeat=1) * 1000:9.1f} ms')
+            print(f'  rolling_frame        {timed(analytics.rolling_frame, daily) * 1000:9.1f} ms')
+            analytics.cache.clear()
+            print(f'  trends + runway cold {timed(lambda: (analytics.trends(), analytics.runway()), repeat=1) * 1000:9.1f} ms')
+            print(f'  trends + runway hit  {timed(lambda: (analytics.trends(), analytics.runway())) * 1000:9.3f} ms')
+        finally:
+            os.chdir(cwd)
+
+def identity(data):
+    return data
+
+def bench_profiling_overhead(calls = 100000):
+    """Added cost of a profiled call when the thread isn't recording, and when it is"""
+    print(f'profiling overhead, {calls} calls')
+    data = pd.DataFrame({'UAH': np.ones(10)})
+    wrapped = profiling.profiled(identity)
+    plain = timed(lambda: [identity(data) for _ in range(calls)], repeat=1)
+    disabled = timed(lambda: [wrapped(data) for _ in range(calls)], repeat=1)
+    profiling.start()
+    enabled = timed(lambda: [wrapped(data) for _ in range(calls)], repeat=1)
+    profiling.stop()
+    added = lambda seconds: (seconds - plain) / calls * 1e6
+    print(f'  disabled +{added(disabled):5.2f} us/call, recording +{added(enabled):5.2f} us/call')
+
+MICRO_BENCHMARKS = [bench_sum_by_period_by_category, bench_format_money, bench_stack_bar_plot, bench_cold_start,
+                    bench_shared_sessions, bench_profiling_overhead, bench_compact_dtypes,
+                    bench_currency, bench_trends, bench_categorize]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ETL, aggregation and charting stages')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--micro', action='store_true', help='run the micro benchmarks instead')
+    args = parser.parse_args()
+
+    if args.micro:
+        for bench in MICRO_BENCHMARKS:
+            bench()
+        sys.exit()
+
+    results = {str(rows): run_pipeline_benchmarks(rows, args.repeat) for rows in args.rows}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+    elif regressions:
+        sys.exit(f'{len(regressions)} stages slower than the baseline')
@@ -0,0 +1,81 @@
+# Category mapping rules used by ETL.categorize_txs
+#
+# Rules of a side run in ascending priority, a later rule overrides an earlier one.
+# match types:
+#   'subcategory' - Category equals pattern, take the Subcategory value
+#   'equals'      - Category equals pattern
+#   'replace'     - replace the pattern substring in Category
+#   'account'     - To Account (donations) / From Account (spending) equals pattern
+#   'category'    - Category matches the pattern regex, case insensitive
+#   'commentary'  - Commentary contains the pattern, case insensitive (must be the highest priorities)
+
+RULE_COLUMNS = ['side', 'match', 'pattern', 'category', 'priority']
+
+RULES = [
+    # donations
+    ('donations', 'subcategory', 'Донати',                              None,                       10),
+    ('donations', 'subcategory', 'Гранти',                              None,                       20),
+    ('donations', 'subcategory', 'Income categories',                   None,                       30),
+    ('donations', 'replace',     'Адмін Донати',                        'Адмін',                    40),
+    ('donations', 'replace',     'Донати ',                             '',                         50),
+    #('donations', 'account',    'ПриватБанк Люті пташки',              'Люті пташки',              60),
+    ('donations', 'account',     'Приват 1000 дронів для України',      '1000 дронів для України',  60),
+    ('donations', 'account',     'Вікторі Дронс',                       'Victory Drones',           60),
+    ('donations', 'account',     'ПриватБанк Загальний рахунок зборів', 'Загальні донати',          60),
+    ('donations', 'account',     'Приват Загальний рахунок зборів',     'Загальні донати',          60),
+    ('donations', 'account',     'ПриватБанк PLN',                      'Загальні донати',          60),
+    ('donations', 'account',     'ПриватБанк Адмін рахунок',            'Адмін',                    60),
+    ('donations', 'account',     'Приват Літай',                        'Літай',                    60),
+    ('donations', 'account',     'Приват На захисті краси України',     'На захисті краси України', 60),
+    ('donations', 'replace',     'Грант МЛПК',                          'МЛПК',                     70),
+    ('donations', 'commentary',  'люті пташки',                         'Люті пташки',              80),
+    ('donations', 'commentary',  'MOBILE LAUNDRY SHOWER UNITS',         'МЛПК',                     81),
+    ('donations', 'commentary',  'From UK ONLINE GIVING FOUNDATION',    'Загальні донати',          82),
+
+    # spending
+    ('spending',  'subcategory', 'Закупівлі',                           None,                       10),
+    ('spending',  'equals',      'Taxes',                               'Адмін',                    20),
+    ('spending',  'equals',      'ремонт Авто',                         'Адмін',                    20),
+    ('spending',  'equals',      'Юридичні послуги',                    'Адмін',                    20),
+    ('spending',  'equals',      'Salary',                              'Адмін',                    20),
+    ('spending',  'account',     'ПриватБанк Адмін рахунок',            'Адмін',                    30),
+    ('spending',  'replace',     'техніки Літай',                       'Літай',                    40),
+    ('spending',  'replace',     'Закупівлі на захисті краси',          'На захисті краси України', 41),
+    ('spending',  'replace',     'Закупівля ',                          '',                         42),
+    ('spending',  'replace',     'Дрони Люті пташки',                   'Люті пташки',              43),
+    ('spending',  'replace',     'Адміністративні витрати',             'Адмін',                    44),
+    ('spending',  'account',     'Приват Банк Адмін рахунок',           'Адмін',                    50),
+    ('spending',  'account',     'Вікторі Дронс',                       'Victory Drones',           50),
+    ('spending',  'account',     'Приват Літай',                        'Літай',                    50),
+    ('spending',  'account',     'Приват На захисті краси України',     'На захисті краси України', 50),
+    ('spending',  'category',    'Лопати|Антени|Піротехніка|Планшети',  'Лопати + Антени + Піротехніка + Планшети', 60),
+    ('spending',  'replace',     'Suppliers and Contractors',           'Адмін',                    70),
+    ('spending',  'category',    'Канцелярія',                          'Адмін',                    80),
+    ('spending',  'category',    'обладнання',                          'Обладнання',               81),
+    ('spending',  'category',    'Комісія банку',                       'Адмін',                    82),
+    ('spending',  'category',    'бухгалтерські послуги',               'Адмін',                    83),
+]
+
+# rows dropped before categorization: (side, Commentary substring, case sensitive)
+EXCLUSIONS = [
+    ('donations', 'Переказ між рахунками організації', True),
+    ('donations', 'Гривнi вiд продажу',                True),
+    ('spending',  'Переказ між рахунками організації', True),
+    ('spending',  'продаж',                            False),
+    ('spending',  'списання',                          False),
+]
+
+# donations dropped from the donor ranking when any text column contains one of these
+DONOR_EXCLUSIONS = ['продажу валюти', 'Луценко Ігор Вікторович']
+
+# (Commentary substring, donor), the first matching alias wins
+DONOR_ALIASES = [
+    ('РУШ',                           'eva.ua'),
+    ('КОНСАЛТИНГОВА ГРУПА',           'КОНСАЛТИНГОВА ГРУПА "A-95"'),
+    ('UNITED HELP UKRAINE',           'UNITED HELP UKRAINE'),
+    ('АМІК УКРАЇНА',                  'АМІК УКРАЇНА'),
+    ('Торгович Оксана Станіславівна', 'Приват Банк'),
+    ('РО "УКУ УГКЦ"',                 'РО "УКУ УГКЦ"'),
+    ('ФОНД "ДЯКУЮ ТОБІ"',             'БФ "ДЯКУЮ ТОБІ"'),
+    ('ТОВ "ФК "ЕВО"',                 'ТОВ "ФК "ЕВО"'),
+]
@@ -1,9 +1,182 @@
 import data_aggregation_tools as da
 import ETL as etl
+import analytics
 import plotly.graph_objects as go
 import data_aggregation_tools as da
 import plotly.express as px
 from plotly.subplots import make_subplots
+import functools
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import profiling
+
+# figure cache, least recently used figures are evicted past either limit
+FIGURE_CACHE_MAX_ENTRIES = 128
+FIGURE_CACHE_MAX_BYTES = 64 * 2**20
+
+figure_cache = OrderedDict()
+figure_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+_figure_keys = {}
+_figure_cache_lock = threading.Lock()
+
+def figure_key(name, args, kwargs):
+    """Hash of a builder call: frames by content, cached figures by their own key, the rest by value.
+    None when an argument can't be keyed"""
+    parts = [name]
+    for value in list(args) + [item for pair in sorted(kwargs.items()) for item in pair]:
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            parts.append(etl.frame_fingerprint(value))
+        elif isinstance(value, go.Figure):
+            if id(value) not in _figure_keys:
+                return None
+            parts.append(_figure_keys[id(value)])
+        else:
+            parts.append(repr(value))
+    return hashlib.sha1('\x1f'.join(parts).encode()).hexdigest()
+
+def _cache_lookup(builder, args, kwargs):
+    """(figure, json) of a builder call, built and stored on a miss"""
+    key = figure_key(builder.__name__, args, kwargs)
+    if key is not None:
+        with _figure_cache_lock:
+            if key in figure_cache:
+                figure_cache.move_to_end(key)
+                figure_cache_stats['hits'] += 1
+                return figure_cache[key]
+
+    fig = builder(*args, **kwargs)
+    if fig is None or key is None:
+        return fig, None
+
+    entry = (fig, fig.to_json())
+    with _figure_cache_lock:
+        figure_cache_stats['misses'] += 1
+        if key not in figure_cache:
+            figure_cache[key] = entry
+            _figure_keys[id(fig)] = key
+            figure_cache_stats['bytes'] += len(entry[1])
+        while figure_cache and (len(figure_cache) > FIGURE_CACHE_MAX_ENTRIES
+                                or figure_cache_stats['bytes'] > FIGURE_CACHE_MAX_BYTES):
+            _, (old_fig, old_json) = figure_cache.popitem(last=False)
+            _figure_keys.pop(id(old_fig), None)
+            figure_cache_stats['bytes'] -= len(old_json)
+    return entry
+
+def cached_figure(builder):
+    """Memoize a figure builder on its input data and parameters, the returned figures are
+    shared between callers and must not be modified. builder.json(...) returns the serialized figure"""
+    @functools.wraps(builder)
+    def wrapper(*args, **kwargs):
+        return _cache_lookup(builder, args, kwargs)[0]
+
+    def json(*args, **kwargs):
+        fig, fig_json = _cache_lookup(builder, args, kwargs)
+        return fig_json if fig_json is not None else fig.to_json()
+
+    wrapper.json = json
+    return wrapper
+
+def clear_figure_cache():
+    with _figure_cache_lock:
+        figure_cache.clear()
+        _figure_keys.clear()
+        figure_cache_stats['bytes'] = 0
+
+def payload_bytes(fig):
+    """Size of the serialized figure, taken from the cache when the figure was built there"""
+    with _figure_cache_lock:
+        entry = figure_cache.get(_figure_keys.get(id(fig)))
+    return len(entry[1]) if entry else len(fig.to_json())
+
+# downsampling, points per trace are capped by the chart width in pixels
+CHART_WIDTH_PX = 1200
+BAR_PX = 4
+LINE_PX = 2
+
+def lttb(x, y, threshold):
+    """Indices of the threshold points kept by largest-triangle-three-buckets"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = [0]
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            with np.errstate(invalid='ignore'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                next_x, next_y = x[hi:edges[i + 2]].mean(), np.nanmean(y[hi:edges[i + 2]])
+        else:
+            next_x, next_y = x[-1], y[-1]
+        prev_x, prev_y = x[keep[-1]], y[keep[-1]]
+        area = np.abs((prev_x - next_x) * (y[lo:hi] - prev_y) - (prev_x - x[lo:hi]) * (next_y - prev_y))
+        keep.append(lo + int(np.argmax(np.nan_to_num(area, nan=-1))))
+    keep.append(n - 1)
+    return np.array(keep)
+
+def _numeric_x(x):
+    """x as floats for the triangle areas, positions when x isn't numeric or dates"""
+    x = pd.Series(x)
+    if pd.api.types.is_numeric_dtype(x):
+        return x.to_numpy(dtype=float)
+    try:
+        return pd.to_datetime(x).astype('int64').to_numpy(dtype=float)
+    except (ValueError, TypeError):
+        return np.arange(len(x), dtype=float)
+
+def _regroup_bars(fig, traces, threshold):
+    """Sum every trace over buckets of consecutive x values so that no trace has more than threshold bars,
+    the buckets are shared by all traces so stacks and groups stay aligned. A bucket is labelled with its
+    earliest x value"""
+    positions = pd.Index(pd.unique(np.concatenate([np.asarray(trace.x, dtype=object) for trace in traces])))
+    # a sparse trace appends its own x values after those of the traces before it
+    positions = positions[np.argsort(_numeric_x(positions), kind='stable')]
+    size = -(-len(positions) // threshold)
+    starts = positions[::size]
+
+    for trace in traces:
+        buckets = positions.get_indexer(np.asarray(trace.x, dtype=object)) // size
+        present = np.unique(buckets)
+        y = np.bincount(buckets, weights=np.nan_to_num(np.asarray(trace.y, dtype=float)), minlength=len(starts))[present]
+        trace.update(x=starts[present].tolist(), y=y)
+        if trace.type == 'bar' and trace.text is not None:
+            trace.text = etl.format_money_vec(y)
+
+    # horizontal mean lines: the mean of a bucket sum grows with the bucket size
+    shapes = []
+    for shape in fig.layout.shapes:
+        if shape.type == 'line' and shape.y0 == shape.y1 and shape.y0 is not None:
+            shape = shape.update(x0=starts[0], x1=starts[-1], y0=shape.y0 * len(positions) / len(starts),
+                                 y1=shape.y1 * len(positions) / len(starts))
+        shapes.append(shape)
+    fig.layout.shapes = shapes
+
+@profiling.profiled
+@cached_figure
+def downsample_figure(fig, width = CHART_WIDTH_PX):
+    """Copy of fig with at most width / BAR_PX bars and width / LINE_PX line points per trace.
+    Bars are regrouped into buckets of consecutive periods, lines keep their LTTB points"""
+    fig = go.Figure(fig)
+    traces = [trace for trace in fig.data if trace.type in ('bar', 'scatter', 'scattergl') and trace.x is not None]
+    if not traces:
+        return fig
+
+    bars = [trace for trace in traces if trace.type == 'bar']
+    bar_threshold = width // BAR_PX
+    if bars and max(len(trace.x) for trace in bars) > bar_threshold:
+        _regroup_bars(fig, traces, bar_threshold)
+        return fig
+
+    line_threshold = width // LINE_PX
+    for trace in traces:
+        if trace.type != 'bar' and len(trace.x) > line_threshold:
+            keep = lttb(_numeric_x(trace.x), np.asarray(trace.y, dtype=float), line_threshold)
+            trace.update(x=np.asarray(trace.x, dtype=object)[keep], y=np.asarray(trace.y, dtype=float)[keep])
+    return fig
 
 def hide_axis_title(fig):
     fig.update_layout(margin=dict(l=0, r=0, b=0), yaxis_title='')
@@ -23,6 +196,8 @@ def fig_add_mean(fig, val, col):
     )
     return fig
 
+@profiling.profiled
+@cached_figure
 def subplot_horizontal(fig1, fig2, rows, cols, type1, type2, title1, title2, show):
     fig = make_subplots(rows=rows, cols=cols,
                     specs=[[{'type': type1}, {'type': type2}]],
@@ -63,6 +238,8 @@ def subplot_vertical(val, fig1, fig2, rows, cols, type1, type2, barmode, title1,
     else:
         return fig
 
+@profiling.profiled
+@cached_figure
 def pie_plot(data, col, title, show):
     """ pie plot with hole"""
     fig = px.pie(data,
@@ -98,18 +275,27 @@ def bar_plot_horizontal(data, col, title):
 
     fig.show(renderer="notebook")
 
-def stack_bar_plot(df, title, show):
-    """stacked bar plot with mean"""
-    df['Date'] = df['Date'].astype(str)
-    mean_value = df[df.columns[1:]].sum(axis=1).mean()
-
-    fig = go.Figure()
-    for column in df.columns[1:]:
-        fig.add_trace(
-                go.Bar(name=column, x = df['Date'], y = df[column],
-                       text = df[column].apply(etl.format_money)
-        ))
-
+@profiling.profiled
+def stack_bar_plot(data, title, show, category = 'Category', value = 'UAH'):
+    """stacked bar plot with mean from long Date, category, value rows sorted by category,
+    a trace per category"""
+    dates = data['Date']
+    if isinstance(dates.dtype, pd.PeriodDtype):
+        dates = dates.dt.start_time
+    codes, periods = pd.factorize(dates, sort=True)
+    labels = np.asarray(periods.strftime('%Y-%m-%d'), dtype=object)
+    x = labels[codes]
+    y = data[value].to_numpy(dtype=float)
+    text = etl.format_money_vec(y)
+    mean_value = np.bincount(codes, weights=y).mean() if len(y) else 0
+
+    # a category's rows are contiguous, one slice per trace
+    names = data[category].to_numpy()
+    bounds = np.flatnonzero(names[1:] != names[:-1]) + 1
+    traces = [dict(type='bar', name=str(names[lo]), x=x[lo:hi], y=y[lo:hi], text=text[lo:hi])
+              for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(names)])] if len(names) else []
+
+    fig = go.Figure(data=traces)
     fig.update_layout(
     barmode='stack',
     title = title,
@@ -119,30 +305,29 @@ def stack_bar_plot(df, title, show):
         shapes=[
             dict(
                 type='line',
-                x0=df['Date'].iloc[0],
-                x1=df['Date'].iloc[-1],
+                x0=labels[0],
+                x1=labels[-1],
                 y0=mean_value,
                 y1=mean_value,
                 line=dict(color='blue', dash='dot')
             )
-        ]
+        ] if len(labels) else []
     )
     if show:
         fig.show(renderer="notebook")
     else:
         return fig
 
-def line_plot(val, col, title, show):
-    """ line plot with moving average"""
+def line_plot(val, col, title, show, days = 14):
+    """ line plot with the moving average over calendar days, val is indexed by date"""
     fig = px.line(val, x = val.index, y = val[col], title = title)
     fig.update_traces(line=dict(color='green'))
 
-    # Add the moving average
-    window = 14
-    moving_avg = val[col].rolling(window=window).mean()
+    # Add the moving average, days without transactions count as 0
+    moving_avg = analytics.rolling(val[col], days, 'mean')
 
-    fig.add_trace(go.Scatter(x = val.index, y = moving_avg,
-                             mode='lines', name=f'{window}-Day Moving Average',
+    fig.add_trace(go.Scatter(x = moving_avg.index, y = moving_avg,
+                             mode='lines', name=f'{days}-Day Moving Average',
                              showlegend = False,
                              line=dict(color='orange', dash = 'dot') ))
     hide_axis_title(fig)
@@ -153,6 +338,15 @@ def line_plot(val, col, title, show):
     else:
         return fig
 
+@profiling.profiled
+@cached_figure
+def trend_plot(data, cols, title):
+    """ a line per column over the date index"""
+    fig = go.Figure([go.Scatter(x=data.index, y=data[col], mode='lines', name=col) for col in cols])
+    fig.update_layout(title=title, legend=dict(orientation='h', y=-0.1))
+    hide_axis_title(fig)
+    return fig
+
 def bar_plot_with_line(df, col, fig_title, show):
 
     fig = go.Figure()
@@ -167,7 +361,7 @@ def bar_plot_with_line(df, col, fig_title, show):
     go.Bar(x = df.index,
             y = df[col],
             marker_color = df['color'],
-            text = [f'{round(val/1e6, 2)}M' for val in df[col]],
+            text = etl.format_money_vec(df[col]),
             textposition='auto'
         )
     )
@@ -191,9 +385,11 @@ def bar_plot_with_line(df, col, fig_title, show):
     else:
         return fig
 
+@profiling.profiled
+@cached_figure
 def bar_plot_grouped(data, col1, col2, fig_title, show):
-    trace1 = go.Bar(x=data.index, y=data[col1], name=col1, text=data[col1].apply(etl.format_money), marker_color = 'blue')
-    trace2 = go.Bar(x=data.index, y=data[col2], name=col2, text=data[col2].apply(etl.format_money), marker_color = 'yellow')
+    trace1 = go.Bar(x=data.index, y=data[col1], name=col1, text=etl.format_money_vec(data[col1]), marker_color = 'blue')
+    trace2 = go.Bar(x=data.index, y=data[col2], name=col2, text=etl.format_money_vec(data[col2]), marker_color = 'yellow')
 
     layout = go.Layout(
         barmode='group',
@@ -216,11 +412,11 @@ def bar_plot_grouped_general(data, col1, col2, fig_title, show):
 
     trace1 = go.Bar(x=data.index, y = data[col1],
                     name = col1,
-                    text = data[col1].apply(etl.format_money),
+                    text = etl.format_money_vec(data[col1]),
                     marker_color = 'blue')
     trace2 = go.Bar(x = data.index, y = data[col2],
                     name = col2,
-                    text = data[col2].apply(etl.format_money),
+                    text = etl.format_money_vec(data[col2]),
                     marker_color = 'red')
 
     layout = go.Layout(
@@ -237,12 +433,8 @@ def bar_plot_grouped_general(data, col1, col2, fig_title, show):
     else:
         return fig
 
-def chart_by_period(data, categories, period, title):
-    """bar plot by period on top and stacked bar plot by period on the bottom"""
-    data_sum_by_period_by_category = da.sum_by_period_by_category(categories, period, data, 'Category').fillna(0)
-    if period == 'w':
-        data_sum_by_period_by_category['Date'] = data_sum_by_period_by_category['Date'].astype(str).str.split('/').str[0]
-
-    fig = stack_bar_plot(data_sum_by_period_by_category, title, False)
-
-    return fig
+@profiling.profiled
+@cached_figure
+def chart_by_period(data, categories, period, title, value = 'UAH'):
+    """stacked bar plot by period and category, periods are labelled by their start date"""
+    return stack_bar_plot(da.sum_by_period_long(categories, period, data, 'Category', value), title, False, value=value)
@@ -0,0 +1,177 @@
+"""Correctness checks of the optimized code paths against the behaviour they replaced
+
+    python checks.py                  # every check
+    python checks.py regroup_bars     # the named checks
+    python checks.py category_parity
+    python checks.py incremental_update
+
+The checks run on synthetic data, including inputs built to hit the edge cases, and fail with
+an AssertionError naming the first mismatch.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import ETL as etl
+import benchmarks
+import category_rules
+import charting_tools
+import synthetic_export
+
+def check_regroup_bars(days = 1341):
+    """Downsampled stacked bars: every bucket is labelled with a date no later than the dates it
+    covers and sums exactly the bars of those dates, also when a sparse category adds its own dates"""
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2023-02-15', periods=days, freq='D')
+    dense = pd.DataFrame({'Date': dates[days // 2:], 'Category': 'dense', 'UAH': rng.lognormal(8, 1, days - days // 2)})
+    sparse_dates = dates[rng.choice(days, 60, replace=False)]
+    sparse = pd.DataFrame({'Date': sparse_dates, 'Category': 'sparse', 'UAH': rng.lognormal(8, 1, len(sparse_dates))})
+    data = pd.concat([dense, sparse], ignore_index=True)
+
+    fig = charting_tools.chart_by_period(data, ['dense', 'sparse'], 'D', '')
+    small = charting_tools.downsample_figure(fig)
+    assert max(len(trace.x) for trace in small.data) < max(len(trace.x) for trace in fig.data), 'nothing was regrouped'
+
+    labels = np.unique(np.concatenate([pd.to_datetime(np.asarray(trace.x)) for trace in small.data]))
+    for before, after in zip(fig.data, small.data):
+        x = pd.to_datetime(np.asarray(before.x)).to_numpy()
+        y = np.asarray(before.y, dtype=float)
+        bucket = labels.searchsorted(x, side='right') - 1
+        assert (bucket >= 0).all(), f'{before.name}: a bar is dated before the first bucket label'
+        expected = pd.Series(y).groupby(labels[bucket]).sum()
+        got = pd.Series(np.asarray(after.y, dtype=float), index=pd.to_datetime(np.asarray(after.x)))
+        assert (got.index.isin(expected.index)).all(), f'{before.name}: a bucket label is later than the dates it covers'
+        np.testing.assert_allclose(got.sort_index().to_numpy(), expected.sort_index().to_numpy(), err_msg=before.name)
+
+def variants(texts):
+    """Every text as is, in upper and lower case, with text around it and with a trailing space"""
+    return [variant for text in texts
+            for variant in [text, text.upper(), text.lower(), f'x {text} y', f'{text} ']]
+
+def adversarial_export(rows, seed = 0):
+    """Export rows built from the rule table: every pattern and target of a side in several
+    cases, embedded in other text and combined in pairs, so rules overlap, cascade and compete"""
+    rng = np.random.default_rng(seed)
+    sides = {}
+    for side in ['donations', 'spending']:
+        rules = [rule for rule in category_rules.RULES if rule[0] == side]
+        texts = [part for rule in rules for part in rule[2].split('|')] + [rule[3] for rule in rules if rule[3]]
+        accounts = [rule[2] for rule in rules if rule[1] == 'account']
+        commentary = [rule[2] for rule in rules if rule[1] == 'commentary']
+        commentary += [rule[1] for rule in category_rules.EXCLUSIONS if rule[0] == side]
+        sides[side] = {
+            'texts': texts + [''],
+            'categories': variants(texts) + [f'{a} {b}' for a in texts for b in texts if a != b] + [''],
+            'accounts': variants(accounts) + ['Монобанк Банка на дрони'],
+            'commentary': variants(commentary) + [f'{a} {b}' for a in commentary for b in commentary if a != b],
+        }
+
+    donation = rng.random(rows) < 0.5
+    column = lambda key: np.where(donation, rng.choice(np.array(sides['donations'][key], dtype=object), rows),
+                                  rng.choice(np.array(sides['spending'][key], dtype=object), rows))
+    accounts = column('accounts')
+    # half the categories are exactly a pattern or target, so that exact matches chain
+    categories = lambda: np.where(rng.random(rows) < 0.5, column('texts'), column('categories'))
+    # most rows have a commentary no rule or exclusion matches
+    commentary = np.where(rng.random(rows) < 0.3, column('commentary'),
+                          rng.choice(np.array(['Благодійна допомога', 'nan', None], dtype=object), rows))
+    data = pd.DataFrame({
+        'Date': pd.Timestamp('2023-02-15') + pd.to_timedelta(np.sort(rng.integers(0, 600, rows)), unit='D'),
+        'UAH': rng.lognormal(8, 2, rows).round(2),
+        'To Account': np.where(donation, accounts, None),
+        'From Account': np.where(donation, None, accounts),
+        'Category': categories(),
+        'Subcategory': categories(),
+        'Commentary': commentary,
+    })
+    # repeated spending rows
+    return pd.concat([data, data[~donation].sample(rows // 20, random_state=seed)]).sort_values('Date', kind='stable')
+
+def check_category_parity(rows = 30000, seeds = (0, 1, 2)):
+    """categorize_txs against the chained passes it replaced, row for row, on synthetic exports
+    and on exports built to make the rules overlap"""
+    for seed in seeds:
+        for name, export in [('synthetic', synthetic_export.generate_export(rows, seed)),
+                             ('adversarial', adversarial_export(rows, seed))]:
+            raw = etl.read_data(path=io.StringIO(export.to_csv(index=False)))
+            for kind, expected, got in zip(['donations', 'spending'], benchmarks.chained_categorize_txs(raw), etl.categorize_txs(raw)):
+                where = f'{name} export, seed {seed}, {kind}'
+                assert expected.index.equals(got.index), f'{where}: {len(expected)} rows expected, {len(got)} kept'
+                for col in ['Date', 'Kopiykas']:
+                    assert (expected[col].to_numpy() == got[col].to_numpy()).all(), f'{where}: {col} differs'
+                expected_category = expected['Category'].astype(str).to_numpy()
+                got_category = got['Category'].astype(str).to_numpy()
+                mismatch = np.flatnonzero(expected_category != got_category)
+                assert len(mismatch) == 0, (f'{where}: {len(mismatch)} categories differ, first {raw.loc[expected.index[mismatch[0]]].to_dict()} '
+                                            f'expected {expected_category[mismatch[0]]!r}, got {got_category[mismatch[0]]!r}')
+
+def assert_same_txs(got, expected, where):
+    """Pipeline outputs equal up to row order and dtypes"""
+    for name, a, b in zip(etl.OUTPUTS, got, expected):
+        keys = [col for col in ['Date', 'Category'] if col in a]
+        a, b = [data.astype({'Category': str} if 'Category' in data else {}).sort_values(keys, ignore_index=True) for data in (a, b)]
+        pd.testing.assert_frame_equal(a, b, check_dtype=False, obj=f'{where}, {name}')
+
+def check_incremental_update(rows = 30000, seed = 0):
+    """update_txs against a full extract_relevant_txs rebuild: after rows are appended to the
+    export, and after an already processed row was changed, which must trigger a rebuild"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.makedirs('data')
+            lines = open(synthetic_export.write_export('full.csv', rows, seed), 'rb').read().splitlines(keepends=True)
+            full = lambda: etl.extract_relevant_txs(etl.read_data(path='data/export.csv'), None, None, save=False)
+
+            with open('data/export.csv', 'wb') as f:
+                f.write(b''.join(lines[:rows * 2 // 3]))
+            etl.update_txs('data/export.csv')
+            with open('data/export.csv', 'wb') as f:
+                f.write(b''.join(lines))
+            assert_same_txs(etl.update_txs('data/export.csv'), full(), 'appended rows')
+
+            # change the leading digit of the first amounts, the processed prefix keeps its length but not its checksum
+            before = full()
+            header = lines[0].decode().rstrip('\n').split(',')
+            amount = header.index('UAH')
+            for i in range(1, 200):
+                fields = lines[i].decode().split(',')
+                fields[amount] = ('1' if fields[amount][0] == '9' else '9') + fields[amount][1:]
+                lines[i] = ','.join(fields).encode()
+            with open('data/export.csv', 'wb') as f:
+                f.write(b''.join(lines))
+            expected = full()
+            assert not all(a.equals(b) for a, b in zip(before, expected)), 'the changed rows do not change the outputs'
+            assert_same_txs(etl.update_txs('data/export.csv'), expected, 'changed prefix')
+            with open(etl.STATE_PATH) as f:
+                state = json.load(f)
+            assert state['rows'] == rows and state['offset'] == os.path.getsize('data/export.csv'), f'no full rebuild, state {state}'
+            assert_same_txs(etl.read_txs(), expected, 'changed prefix, published')
+        finally:
+            os.chdir(cwd)
+
+CHECKS = {name[len('check_'):]: func for name, func in globals().items() if name.startswith('check_')}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the optimized code paths against their references')
+    parser.add_argument('checks', nargs='*', help=f'checks to run, all by default: {", ".join(CHECKS)}')
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f'unknown checks {sorted(unknown)}')
+
+    failed = 0
+    for name in args.checks or CHECKS:
+        try:
+            CHECKS[name]()
+            print(f'ok      {name}')
+        except AssertionError as error:
+            failed += 1
+            print(f'FAILED  {name}: {error}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,130 @@
+"""Conversion of the UAH amounts with a local daily FX table
+
+The table is data/fx_rates.parquet or data/fx_rates.csv: a Date column and a column per currency
+holding the UAH price of one unit on that day (e.g. the NBU official rates). Nothing is fetched
+over the network, without the table only UAH is available. An amount is converted with the rate
+of its Date or, when that day is missing, of the latest day before it (an as-of join). Amounts
+dated before the first rate of the table convert to NaN, so the table should start no later than
+the export.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import ETL as etl
+import data_aggregation_tools as da
+import profiling
+
+FX_PATHS = ['data/fx_rates.parquet', 'data/fx_rates.csv']
+CURRENCIES = ['USD', 'EUR']
+# converted datasets kept for the currency selector, a few per currency
+CACHE_MAX_ENTRIES = 32
+
+_rates = {}
+converted_cache = OrderedDict()
+converted_stats = {'hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+def rates_path():
+    """The FX table in use, None when there is none"""
+    return next((path for path in FX_PATHS if os.path.exists(path)), None)
+
+def rates_stamp(path = None):
+    path = path or rates_path()
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+def load_rates(path):
+    if path.endswith('.parquet'):
+        rates = pd.read_parquet(path)
+    else:
+        rates = pd.read_csv(path, parse_dates=['Date'])
+    rates['Date'] = pd.to_datetime(rates['Date']).dt.floor('D')
+    columns = [col for col in CURRENCIES if col in rates.columns]
+    rates = rates[['Date'] + columns].astype({col: 'float64' for col in columns})
+    if (rates[columns] <= 0).any().any():
+        raise ValueError(f'{path}: FX rates must be positive')
+    return rates.dropna(subset=['Date']).sort_values('Date', kind='stable').drop_duplicates('Date', keep='last').reset_index(drop=True)
+
+def read_rates(path = None):
+    """The FX table sorted by Date, read again only when the file changes. None when there is no table"""
+    stamp = rates_stamp(path)
+    if stamp is None:
+        return None
+    with _lock:
+        cached = _rates.get(stamp[0])
+        if cached and cached[0] == stamp:
+            return cached[1]
+    rates = load_rates(stamp[0])
+    with _lock:
+        _rates[stamp[0]] = (stamp, rates)
+    return rates
+
+def available(rates = None):
+    """Currencies the amounts can be shown in, UAH first"""
+    rates = read_rates() if rates is None else rates
+    if rates is None:
+        return ['UAH']
+    return ['UAH'] + [col for col in CURRENCIES if col in rates.columns]
+
+def rate_on(dates, rates, currency):
+    """UAH per unit of currency in effect on every date: one binary search over the sorted table"""
+    table = rates[['Date', currency]].dropna()
+    days = pd.DatetimeIndex(dates).floor('D').as_unit(table['Date'].dt.unit)
+    positions = table['Date'].to_numpy().searchsorted(days.to_numpy(), side='right') - 1
+    rate = table[currency].to_numpy()[np.maximum(positions, 0)]
+    return np.where(positions >= 0, rate, np.nan)
+
+@profiling.profiled
+def convert(data, currencies = None, rates = None, value = 'UAH'):
+    """Copy of data with a column per currency next to the UAH value column, the input is left as is"""
+    rates = read_rates() if rates is None else rates
+    currencies = [currency for currency in (currencies or available(rates)) if currency != value]
+    if currencies and rates is None:
+        raise FileNotFoundError(f'no FX table, expected one of {FX_PATHS}')
+    amounts = data[value].to_numpy(dtype='float64')
+    return data.assign(**{currency: amounts / rate_on(data['Date'], rates, currency) for currency in currencies})
+
+def convert_cube(cube, currency, rates):
+    """Rollup cube in currency: the daily cells are converted and rolled up again, a month is
+    the sum of its days at their own rates"""
+    daily = cube.xs('D', level='level').reset_index()
+    daily['UAH'] = convert(daily, [currency], rates)[currency]
+    by_category = {key: part.drop(['kind', 'size'], axis=1) for key, part in daily.groupby(['kind', 'size'], sort=False)}
+    return da.rollup_cube(by_category).rename(currency)
+
+def converted(name, currency):
+    """A dataset with its amounts in currency, converted once per dataset and FX table version.
+    The frames get a currency column next to UAH, the cube is returned in currency and the
+    KPI snapshot is rebuilt from the converted totals.
+    Shared between sessions, must not be modified"""
+    data = etl.get_dataset(name)
+    if currency == 'UAH':
+        return data
+
+    key = (name, currency, etl.dataset_stamp(name), rates_stamp())
+    with _lock:
+        if key in converted_cache:
+            converted_cache.move_to_end(key)
+            converted_stats['hits'] += 1
+            return converted_cache[key]
+        converted_stats['misses'] += 1
+
+    rates = read_rates()
+    if name == 'kpis':
+        totals = [converted(output, currency) if output.endswith('_total') else None for output in etl.OUTPUTS]
+        result = etl.build_kpis(totals, currency)
+    elif name == 'rollup_cube':
+        result = convert_cube(data, currency, rates)
+    else:
+        result = convert(data, [currency], rates)
+    with _lock:
+        converted_cache[key] = result
+        while len(converted_cache) > CACHE_MAX_ENTRIES:
+            converted_cache.popitem(last=False)
+    return result
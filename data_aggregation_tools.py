@@ -1,5 +1,6 @@
 import pandas as pd
 import datetime as dt
+import profiling
 
 def sum_category_by_date(category_name, period, data, category, value = 'UAH'):
     return pd.DataFrame(data[((
@@ -7,13 +8,115 @@ def sum_category_by_date(category_name, period, data, category, value = 'UAH'):
             data['Date'].dt.to_period(period)).sum().reset_index(name = category_name))
 
 
+@profiling.profiled
 def sum_by_period_by_category(categories, period, data, category, value = 'UAH'):
-    data_frames = []
-    for category_name in categories:
-        data_frames.append(sum_category_by_date(category_name, period, data, category, value))
+    """Period x category matrix from one groupby, a column per category in the given order"""
+    codes = pd.Categorical(data[category], categories=categories)
+    sums = data[value].groupby([data['Date'].dt.to_period(period).rename('Date'), codes], observed=True).sum().unstack()
+    sums = sums.reindex(columns=categories)
+    sums.columns = list(categories)
+    return sums.reset_index()
 
-    from functools import reduce
-    return reduce(lambda left, right: pd.merge(left, right, on='Date', how='outer'), data_frames)
+@profiling.profiled
+def sum_by_period_long(categories, period, data, category, value = 'UAH'):
+    """Date, category, value rows summed by period, sorted by category in the given order then by Date.
+    Categories outside the list are dropped"""
+    codes = pd.Categorical(data[category], categories=categories)
+    sums = data[value].groupby([codes, data['Date'].dt.to_period(period).rename('Date')], observed=True).sum()
+    return sums.rename_axis([category, 'Date']).reset_index()
 
 def sum_by_period(data, period):
-    return pd.DataFrame(data['UAH'].groupby(data['Date'].dt.to_period(period)).sum())
\ No newline at end of file
+    return pd.DataFrame(data['UAH'].groupby(data['Date'].dt.to_period(period)).sum())
+
+# rollup levels of the cube, the daily level is the base grain
+LEVELS = ['D', 'W', 'M', 'Y']
+
+@profiling.profiled
+def rollup_cube(by_category):
+    """UAH sums indexed by (kind, size, level, Date, Category), Date is the start of the period.
+    by_category maps (kind, size) to Date, Category, UAH rows"""
+    parts = []
+    for (kind, size), data in by_category.items():
+        daily = data.groupby([data['Date'].dt.floor('D'), 'Category'], observed=True)['UAH'].sum()
+        dates = daily.index.get_level_values('Date')
+        categories = daily.index.get_level_values('Category')
+        for level in LEVELS:
+            if level == 'D':
+                rolled = daily
+            else:
+                rolled = daily.groupby([dates.to_period(level).start_time.rename('Date'), categories], observed=True).sum()
+            parts.append(rolled.reset_index().assign(kind=kind, size=size, level=level))
+
+    cube = pd.concat(parts, ignore_index=True)
+    return cube.set_index(['kind', 'size', 'level', 'Date', 'Category'])['UAH'].sort_index()
+
+def cube_cell(cube, kind, size, level):
+    """The sums of one cube cell indexed by (Date, Category), empty when the cell has no rows,
+    e.g. no spending at or above the large amount"""
+    try:
+        return cube.loc[(kind, size, level)]
+    except KeyError:
+        index = pd.MultiIndex.from_arrays([cube.index.levels[3][:0], cube.index.levels[4][:0]], names=['Date', 'Category'])
+        return pd.Series([], index=index, dtype='float64', name=cube.name)
+
+@profiling.profiled
+def cube_slice(cube, kind, size, level, start = None):
+    """Date, Category, UAH rows of one cube cell, with start the days before it are cut
+    before rolling up to the level"""
+    if start is None:
+        return cube_cell(cube, kind, size, level).reset_index()
+
+    daily = cube_cell(cube, kind, size, 'D').loc[pd.Timestamp(start):]
+    if level != 'D':
+        dates = daily.index.get_level_values('Date').to_period(level).start_time.rename('Date')
+        daily = daily.groupby([dates, daily.index.get_level_values('Category')], observed=True).sum()
+    return daily.reset_index()
+
+@profiling.profiled
+def cube_totals(cube, kind, size, level):
+    """UAH by period of one cube cell summed over the categories"""
+    return pd.DataFrame(cube_cell(cube, kind, size, level).groupby(level='Date').sum())
+
+# named dashboard windows, the aliases are the labels used by the selectboxes
+WINDOWS = {
+    'latest day': None,
+    '1 week': pd.DateOffset(weeks=1),
+    '1 month': pd.DateOffset(months=1),
+    '3 months': pd.DateOffset(months=3),
+    '6 months': pd.DateOffset(months=6),
+    '1 year': pd.DateOffset(years=1),
+    'since launch': None,
+}
+WINDOW_ALIASES = {'day': 'latest day', 'week': '1 week', 'month': '1 month', '3 month': '3 months',
+                  'year': '1 year', 'all time': 'since launch'}
+
+def window_name(window):
+    """Canonical name of a window label, whitespace and case insensitive"""
+    name = ' '.join(window.split()).lower()
+    name = WINDOW_ALIASES.get(name, name)
+    if name not in WINDOWS:
+        raise ValueError(f'unknown window {window!r}, expected one of {list(WINDOWS)}')
+    return name
+
+def window_start(window, today = None):
+    """First day of a named window ending today, None for since launch and latest day"""
+    offset = WINDOWS[window_name(window)]
+    if offset is None:
+        return None
+    return pd.Timestamp(today or pd.Timestamp.now()).floor('D') - offset
+
+@profiling.profiled
+def date_window(data, window, today = None):
+    """Rows of data within a named window by binary search over its dates: a sorted DatetimeIndex
+    or a sorted Date column. A row is in the window when its Date, the start of its period, is on
+    or after the window start, the latest day is the last Date in data"""
+    dates = data.index if isinstance(data.index, pd.DatetimeIndex) else data['Date']
+    if len(dates) == 0:
+        return data
+    if window_name(window) == 'latest day':
+        start = dates[-1] if isinstance(dates, pd.Index) else dates.iloc[-1]
+    else:
+        start = window_start(window, today)
+        if start is None:
+            return data
+    return data.iloc[dates.searchsorted(start, side='left'):]
@@ -0,0 +1,198 @@
+"""Opt-in timing of the ETL, aggregation and charting calls
+
+    profiling.start()
+    ...
+    records = profiling.stop()
+    profiling.summary(records)
+
+Functions decorated with profiled and blocks under section record wall time, rows in/out and
+the RSS delta of every call made by the thread between start and stop. The records export as
+JSON or as folded stacks for flamegraph.pl / speedscope. When the thread isn't recording a
+decorated call costs one attribute lookup. peak_rss measures the peak RSS of a block.
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_local = threading.local()
+_PAGE_MB = os.sysconf('SC_PAGE_SIZE') / 2**20 if hasattr(os, 'sysconf') else 0
+# ru_maxrss is in bytes on macOS and in KB on Linux
+_MAXRSS_MB = 1 / 2**20 if sys.platform == 'darwin' else 1 / 1024
+
+def max_rss_mb():
+    """Peak resident memory of the process so far from getrusage, None where it isn't available"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_MB
+
+def rss_mb():
+    """Resident memory of the process from /proc. Without /proc (e.g. macOS) the peak so far
+    from getrusage, an upper bound of it, and None where neither can be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_MB
+    except OSError:
+        return max_rss_mb()
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS of the process to its current RSS, False where that isn't supported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak resident memory of the process since it started or since reset_peak_rss, from /proc
+    or else getrusage, None where neither can be read"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return max_rss_mb()
+
+class peak_rss:
+    """Context manager keeping in mb the peak RSS of the process during the block: the kernel's
+    high-water mark reset on entry, or where it can't be reset rss_mb sampled every interval
+    seconds by a thread. Without /proc that is the peak of the process so far, and mb is None
+    where the RSS can't be read at all"""
+
+    def __init__(self, interval = 0.01):
+        self.interval = interval
+        self.mb = None
+
+    def __enter__(self):
+        self.mb = rss_mb()
+        self.exact = reset_peak_rss()
+        if not self.exact and self.mb is not None:
+            self._done = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, name='peak-rss', daemon=True)
+            self._sampler.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.mb = max(self.mb, rss_mb())
+
+    def __exit__(self, *exc):
+        if self.exact:
+            self.mb = max(self.mb, peak_rss_mb())
+        elif self.mb is not None:
+            self._done.set()
+            self._sampler.join()
+            self.mb = max(self.mb, rss_mb())
+        return False
+
+def rows(value):
+    """Rows of a frame or series, summed over a tuple or list of them, None for anything else"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        counts = [rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+def start():
+    """Record the profiled calls of this thread"""
+    _local.records = []
+    _local.stack = []
+
+def stop():
+    """Stop recording and return the records of this thread"""
+    records = getattr(_local, 'records', None) or []
+    _local.records = None
+    return records
+
+def extend(records):
+    """Add the records another thread returned from stop to the records of this thread"""
+    if getattr(_local, 'records', None) is not None:
+        _local.records.extend(records)
+
+def recording():
+    return getattr(_local, 'records', None) is not None
+
+class section:
+    """Context manager recording a block, rows_in/rows_out can be set on it inside the block. memory_mb
+    is the change of rss_mb over the block, None where the RSS can't be read"""
+
+    def __init__(self, name, rows_in = None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        self.records = getattr(_local, 'records', None)
+        if self.records is not None:
+            _local.stack.append(self.name)
+            self.memory = rss_mb()
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.records is not None:
+            seconds = time.perf_counter() - self.start
+            self.records.append({
+                'name': self.name,
+                'stack': ';'.join(_local.stack),
+                'start': self.start,
+                'seconds': seconds,
+                'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'memory_mb': None if self.memory is None else rss_mb() - self.memory,
+            })
+            _local.stack.pop()
+        return False
+
+def profiled(func):
+    """Record every call of func made while the thread is recording"""
+    name = f'{func.__module__}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'records', None) is None:
+            return func(*args, **kwargs)
+        rows_in = next((count for count in map(rows, args) if count is not None), None)
+        with section(name, rows_in) as block:
+            result = func(*args, **kwargs)
+            block.rows_out = rows(result)
+        return result
+    return wrapper
+
+def summary(records):
+    """Calls, total and mean time, rows and memory per function, slowest first, memory NaN where it wasn't measured"""
+    if not records:
+        return pd.DataFrame(columns=['calls', 'seconds', 'mean_ms', 'rows_in', 'rows_out', 'memory_mb'])
+    data = pd.DataFrame(records)
+    data['memory_mb'] = pd.to_numeric(data['memory_mb'])
+    table = data.groupby('name').agg(calls=('seconds', 'size'), seconds=('seconds', 'sum'), rows_in=('rows_in', 'sum'),
+                                     rows_out=('rows_out', 'sum'), memory_mb=('memory_mb', lambda mb: mb.sum(min_count=1)))
+    table.insert(2, 'mean_ms', table['seconds'] / table['calls'] * 1000)
+    return table.sort_values('seconds', ascending=False)
+
+def to_json(records):
+    return json.dumps(records, indent=1)
+
+def to_folded(records):
+    """Folded stacks weighted by self time in microseconds, the input of flamegraph.pl and speedscope"""
+    self_time = {}
+    for record in records:
+        self_time[record['stack']] = self_time.get(record['stack'], 0) + record['seconds']
+        parent = record['stack'].rpartition(';')[0]
+        if parent:
+            self_time[parent] = self_time.get(parent, 0) - record['seconds']
+    return '\n'.join(f'{stack} {max(0, round(seconds * 1e6))}' for stack, seconds in sorted(self_time.items())) + '\n'
@@ -0,0 +1,166 @@
+"""Background refresh of the ETL outputs, off the dashboard's request path
+
+    python refresh_worker.py                 # watch data/ExportEN.csv
+    python refresh_worker.py --once          # refresh once if the export changed and exit
+
+The worker polls the export and refreshes the outputs once the export has not been modified for
+the debounce interval, so a half-copied export is not picked up. Every file is published through a
+temp file swapped in with os.replace. The time and duration of the last refresh are kept in
+data/refresh_status.json for the dashboard.
+
+Refreshes publish under ETL.publish_lock, so the dashboard's own worker, a standalone one and the
+ETL command line can run side by side. Outputs published by the ETL command line over several
+exports are kept: the worker then watches those exports and reruns the ETL over them.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import threading
+import time
+
+import ETL as etl
+
+STATUS_PATH = 'data/refresh_status.json'
+POLL_SECONDS = 5
+DEBOUNCE_SECONDS = 10
+
+status = {'last_refresh': None, 'duration': None, 'rows': None, 'error': None, 'refreshes': 0}
+ready = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+def export_stamp(path):
+    """mtime and size of the export, None while it's missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def sources(path = etl.EXPORT_PATH, state_path = etl.STATE_PATH):
+    """The exports the outputs are built from: those of the last ETL command line run, else path"""
+    state = etl.read_state(state_path)
+    return sorted(state['sources']) if state and state.get('sources') else [path]
+
+def exports_stamp(paths):
+    """Stamps of the exports, None while none of them is there"""
+    stamps = [export_stamp(path) for path in paths]
+    return tuple(stamps) if any(stamps) else None
+
+def outputs_current(path = etl.EXPORT_PATH, state_path = etl.STATE_PATH):
+    """True when the persisted outputs were built from the current exports"""
+    state = etl.read_state(state_path)
+    if state is None or state.get('publishing') or state.get('format') != etl.STORAGE_FORMAT or not etl.outputs_exist():
+        return False
+    if state.get('sources'):
+        return all(export_stamp(source) and etl.source_fingerprint(source) == fingerprint
+                   for source, fingerprint in state['sources'].items())
+    return export_stamp(path) is not None and state.get('fingerprint') == etl.source_fingerprint(path)
+
+def refreshable(path = etl.EXPORT_PATH, state_path = etl.STATE_PATH):
+    """True when one of the exports to build the outputs from is there"""
+    return exports_stamp(sources(path, state_path)) is not None
+
+def outputs_ready(state_path = etl.STATE_PATH):
+    """True when there are complete outputs to serve, stale ones included"""
+    state = etl.read_state(state_path)
+    return state is not None and not state.get('publishing') and etl.outputs_exist(state.get('format'))
+
+def write_status(status_path = STATUS_PATH):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(status, f)
+    etl.replace_file(status_path, write)
+
+def read_status(status_path = STATUS_PATH):
+    if not os.path.exists(status_path):
+        return dict(status)
+    with open(status_path) as f:
+        return json.load(f)
+
+def refresh(path = etl.EXPORT_PATH, state_path = etl.STATE_PATH):
+    """Rebuild the outputs from the export: only the appended rows when the processed part
+    is unchanged, otherwise read_data + extract_relevant_txs over the whole export. Outputs of
+    several exports are rebuilt with run_etl over those still there"""
+    start = time.perf_counter()
+    try:
+        state = etl.read_state(state_path)
+        if state and state.get('sources'):
+            etl.run_etl([source for source in sorted(state['sources']) if export_stamp(source)], state_path=state_path)
+        else:
+            etl.update_txs(path, state_path)
+    except Exception as error:
+        status['error'] = repr(error)
+        write_status()
+        raise
+    status.update({
+        'last_refresh': dt.datetime.now().isoformat(timespec='seconds'),
+        'duration': time.perf_counter() - start,
+        'rows': etl.read_state(state_path)['rows'],
+        'error': None,
+        'refreshes': status['refreshes'] + 1,
+    })
+    write_status()
+    ready.set()
+    return status
+
+def watch(path = etl.EXPORT_PATH, poll = POLL_SECONDS, debounce = DEBOUNCE_SECONDS, stop = None):
+    """Refresh whenever the exports change, once they haven't been modified for debounce seconds.
+    ready is set as soon as there are outputs to serve, stale ones included"""
+    stop = stop or threading.Event()
+    published = exports_stamp(sources(path)) if outputs_current(path) else None
+    if outputs_ready():
+        ready.set()
+    while not stop.is_set():
+        stamp = exports_stamp(sources(path))
+        if (stamp is not None and stamp != published
+                and time.time() - max(s[0] for s in stamp if s) / 1e9 >= debounce):
+            if outputs_current(path):
+                # published by another process, e.g. the ETL command line
+                ready.set()
+            else:
+                exports = ', '.join(sources(path))
+                try:
+                    refresh(path)
+                    print(f"refreshed {exports} in {status['duration']:.1f}s")
+                except Exception as error:
+                    print(f'refresh of {exports} failed: {error!r}')
+            published = stamp
+        stop.wait(poll)
+
+def start(path = etl.EXPORT_PATH, poll = POLL_SECONDS, debounce = DEBOUNCE_SECONDS):
+    """Run watch in a daemon thread, once per process. ready is set before returning when there
+    are outputs to serve"""
+    global _worker
+    if outputs_ready():
+        ready.set()
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=watch, args=(path, poll, debounce), name='refresh-worker', daemon=True)
+            _worker.start()
+    return _worker
+
+def wait_ready(path = etl.EXPORT_PATH, timeout = None):
+    """Wait until there are outputs to serve. False once timeout seconds have passed, and at once
+    when there is no export to build them from or the refresh failed"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not ready.wait(1):
+        if status['error'] or not refreshable(path) or (deadline is not None and time.monotonic() >= deadline):
+            return ready.is_set()
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the ETL outputs when the export changes')
+    parser.add_argument('--export', default=etl.EXPORT_PATH)
+    parser.add_argument('--poll', type=float, default=POLL_SECONDS)
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE_SECONDS)
+    parser.add_argument('--once', action='store_true', help='refresh if the export changed and exit')
+    args = parser.parse_args()
+
+    if args.once:
+        if not outputs_current(args.export):
+            refresh(args.export)
+            print(f"refreshed {args.export} in {status['duration']:.1f}s")
+    else:
+        watch(args.export, args.poll, args.debounce)
@@ -0,0 +1,86 @@
+"""Synthetic bank exports with the schema of data/ExportEN.csv
+
+    python synthetic_export.py 1000000 data/synthetic_1M.csv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import category_rules
+
+# share of the rows on each side, the real export is almost all donations
+DONATIONS_SHARE = 0.99
+
+TO_ACCOUNTS = [rule[2] for rule in category_rules.RULES if rule[:2] == ('donations', 'account')] + ['Монобанк Банка на дрони', 'ПриватБанк Люті пташки']
+FROM_ACCOUNTS = [rule[2] for rule in category_rules.RULES if rule[:2] == ('spending', 'account')] + ['Монобанк Банка на дрони']
+
+DONATION_CATEGORIES = ['Донати', 'Гранти', 'Income categories', 'Загальні донати', 'Адмін Донати', 'Transfer', '']
+DONATION_SUBCATEGORIES = ['Донати Люті пташки', 'Донати Літай', 'Грант МЛПК', 'Загальні донати', 'Гранти', '']
+SPENDING_CATEGORIES = ['Закупівлі', 'Taxes', 'Salary', 'ремонт Авто', 'Юридичні послуги', 'Адміністративні витрати',
+                       'Suppliers and Contractors', 'Канцелярія', 'Комісія банку', 'бухгалтерські послуги (аудит)']
+SPENDING_SUBCATEGORIES = ['Закупівля техніки Літай', 'Закупівлі на захисті краси', 'Дрони Люті пташки', 'Закупівля Антени',
+                          'Закупівля Планшети', 'Лопати', 'обладнання', 'МЛПК', '']
+
+# (commentary, weight), donor names are followed by a payment number
+DONATION_COMMENTARY = [
+    ('Благодійна допомога', 60), ('Поповнення', 20), (None, 6),
+    ('люті пташки', 3), ('MOBILE LAUNDRY SHOWER UNITS', 1), ('From UK ONLINE GIVING FOUNDATION', 1),
+    ('Переказ між рахунками організації', 3), ('Гривнi вiд продажу валюти', 1),
+    ('ТОВ РУШ благодійний внесок', 1), ('КОНСАЛТИНГОВА ГРУПА A-95', 1), ('UNITED HELP UKRAINE donation', 1),
+    ('АМІК УКРАЇНА', 1), ('Луценко Ігор Вікторович', 1),
+]
+SPENDING_COMMENTARY = [
+    ('Оплата за товар згідно рахунку', 80), ('Комісія банку', 8),
+    ('Переказ між рахунками організації', 6), ('Продаж валюти', 3), ('Списання коштiв', 3),
+]
+
+def weighted_choice(rng, values, rows):
+    options, weights = zip(*values)
+    weights = np.array(weights, dtype=float)
+    return np.array(options, dtype=object)[rng.choice(len(options), rows, p=weights / weights.sum())]
+
+def generate_export(rows, seed = 0, start = '2023-02-15', end = None):
+    """rows transactions between start and end (today by default) sorted by Date"""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end) if end else pd.Timestamp.now().floor('D')
+
+    donation = rng.random(rows) < DONATIONS_SHARE
+    offsets = np.sort(rng.integers(0, (end - start) // pd.Timedelta(milliseconds=1), rows))
+
+    # donations are mostly small with a long tail, spending is fewer and larger payments
+    amount = np.where(donation, rng.lognormal(6, 1.8, rows), rng.lognormal(9, 2, rows)).round(2)
+
+    commentary = weighted_choice(rng, DONATION_COMMENTARY, rows)
+    commentary[~donation] = weighted_choice(rng, SPENDING_COMMENTARY, (~donation).sum())
+    numbered = donation & (rng.random(rows) < 0.3) & pd.notna(commentary)
+    commentary[numbered] = commentary[numbered] + ' №' + rng.integers(1, 10000, numbered.sum()).astype(str).astype(object)
+
+    return pd.DataFrame({
+        'Date': start + pd.to_timedelta(offsets, unit='ms'),
+        'UAH': amount,
+        'To Account': np.where(donation, rng.choice(TO_ACCOUNTS, rows), None),
+        'From Account': np.where(donation, None, rng.choice(FROM_ACCOUNTS, rows)),
+        'Category': np.where(donation, rng.choice(DONATION_CATEGORIES, rows), rng.choice(SPENDING_CATEGORIES, rows)),
+        'Subcategory': np.where(donation, rng.choice(DONATION_SUBCATEGORIES, rows), rng.choice(SPENDING_SUBCATEGORIES, rows)),
+        'Commentary': commentary,
+    })
+
+def write_export(path, rows, seed = 0, chunksize = 1000000):
+    """Write a synthetic export to path chunksize rows at a time, consecutive date ranges keep it sorted"""
+    chunks = max(1, -(-rows // chunksize))
+    start = pd.Timestamp('2023-02-15')
+    step = (pd.Timestamp.now().floor('D') - start) / chunks
+    for i in range(chunks):
+        data = generate_export(min(chunksize, rows - i * chunksize), seed + i, start + i * step, start + (i + 1) * step)
+        data.to_csv(path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic bank export')
+    parser.add_argument('rows', type=int)
+    parser.add_argument('path')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_export(args.path, args.rows, args.seed)